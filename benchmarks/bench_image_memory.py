@@ -0,0 +1,62 @@
+"""
+Memory of loaded dataset images: the original plain image class against the compact ``ConceptImage`` records.
+
+    python -m benchmarks.bench_image_memory [images] [tags per image] [distinct tags]
+"""
+import gc
+import os
+import random
+import sys
+import tracemalloc
+
+from fking.fking_captions import Concept, ConceptImage
+
+
+class LegacyImage:
+    """
+    The image class before ``__slots__``, relative paths and interned tags: a dict per instance, the absolute path and
+    a list of tag strings.
+    """
+
+    def __init__(self, concept, path: str, tags: list[str]):
+        self.concept = concept
+        self.path = path
+        self.tags = tags
+
+
+def generate_captions(image_count: int, tags_per_image: int, distinct_tags: int) -> list[list[str]]:
+    rng = random.Random(0)
+    return [[str(t) for t in rng.sample(range(distinct_tags), tags_per_image)] for _ in range(image_count)]
+
+
+def measure(image_class, concept: Concept, captions: list[list[str]]) -> int:
+    gc.collect()
+    tracemalloc.start()
+
+    # tag strings are created per image, as reading caption files does
+    images = [
+        image_class(concept, os.path.join(concept.working_directory, f"{i}.png"), [f"tag {t}" for t in tags])
+        for i, tags in enumerate(captions)
+    ]
+
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    del images
+    return size
+
+
+def main(image_count: int = 200_000, tags_per_image: int = 12, distinct_tags: int = 3_000):
+    concept = Concept("global", os.path.join(os.sep, "datasets", "global"), None, [], {})
+    captions = generate_captions(image_count, tags_per_image, distinct_tags)
+
+    legacy_size = measure(LegacyImage, concept, captions)
+    compact_size = measure(ConceptImage, concept, captions)
+
+    print(f"{image_count:,} images, {tags_per_image} tags each out of {distinct_tags:,}")
+    print(f"legacy images: {legacy_size / 2 ** 20:,.1f} MiB")
+    print(f"ConceptImage: {compact_size / 2 ** 20:,.1f} MiB ({legacy_size / compact_size:.1f}x smaller)")
+
+
+if __name__ == "__main__":
+    main(*(int(a) for a in sys.argv[1:4]))
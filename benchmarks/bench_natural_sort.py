@@ -0,0 +1,45 @@
+"""
+Sorting the captioner's concept tree: the legacy comparator over every canonical name against per-directory
+``natural_sort_keys``.
+
+    python -m benchmarks.bench_natural_sort [images] [directories]
+"""
+import random
+import sys
+import time
+from functools import cmp_to_key
+
+from benchmarks.legacy_sort import legacy_compare
+from fking.fking_utils import natural_sorted
+
+
+def main(image_count: int = 200_000, directory_count: int = 1_000):
+    rng = random.Random(0)
+
+    directories: dict[str, list[str]] = {}
+    for d in range(directory_count):
+        directories[f"global.concept_{d}"] = []
+
+    for i in range(image_count):
+        directory = f"global.concept_{rng.randrange(directory_count)}"
+        stem = str(i) if rng.random() < 0.8 else f"img_{i}"
+        directories[directory].append(f"{stem}.{rng.choice(['png', 'jpg'])}")
+
+    canonical_names = [f"{d}.{n}" for d, names in directories.items() for n in names]
+
+    start = time.perf_counter()
+    sorted(canonical_names, key=cmp_to_key(legacy_compare))
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for names in directories.values():
+        natural_sorted(names, lambda n: n)
+    keyed_time = time.perf_counter() - start
+
+    print(f"{image_count:,} images in {directory_count:,} directories")
+    print(f"legacy comparator, global sort: {legacy_time:.2f}s")
+    print(f"natural_sort_keys, per directory: {keyed_time:.2f}s ({legacy_time / keyed_time:.1f}x)")
+
+
+if __name__ == "__main__":
+    main(*(int(a) for a in sys.argv[1:3]))
@@ -0,0 +1,50 @@
+"""
+The legacy ordering of the captioner's concept tree, shared by the natural sort tests and benchmark.
+"""
+from fking.fking_utils import is_image
+
+
+def legacy_compare(a: str, b: str) -> int:
+    """
+    The comparator the captioner sorted canonical names with before ``natural_sort_keys``.
+    """
+    def is_numeric(x) -> (bool, float):
+        try:
+            return True, float(x)
+        except ValueError:
+            return False, None
+
+    def filename(x: str, is_img: bool) -> (str, str):
+        if is_img:
+            i_split = x.split(".")
+            return f"{i_split[-2]}.{i_split[-1]}", i_split[-2]
+        elif "." in x:
+            f = x[(x.rindex(".") + 1):]
+            return f, f
+        else:
+            return x, x
+
+    a_is_image = is_image(a)
+    b_is_image = is_image(b)
+
+    if not a_is_image and b_is_image:
+        return -1
+    elif a_is_image and not b_is_image:
+        return 1
+
+    a_filename, a_name = filename(a, a_is_image)
+    b_filename, b_name = filename(b, b_is_image)
+
+    a_numeric, a_val = is_numeric(a_name)
+    b_numeric, b_val = is_numeric(b_name)
+
+    if a_numeric and b_numeric:
+        a_part = a[:a.rindex(a_filename) - 1]
+        b_part = b[:b.rindex(b_filename) - 1]
+
+        if a_part == b_part:
+            return (a_val > b_val) - (a_val < b_val)
+
+        return (a_part > b_part) - (a_part < b_part)
+
+    return (a > b) - (a < b)
@@ -1,91 +1,90 @@
+import hashlib
 import math
 import os
-import shutil
+from collections.abc import Iterable, Iterator
 
 from PIL import Image
 
 from fking.fking_captions import CaptionedImage, Concept, ConceptImage
-from fking.fking_utils import normalize_tags, write_tags
+from fking.fking_utils import LinkMode, expand_special_tags, link_file, normalize_tags, write_tags
 
 
-def load_image(concept_image: ConceptImage, image_cache: dict[str, Image], max_size: int) -> Image:
-    c_img_name = concept_image.get_canonical_name()
-    if c_img_name in image_cache:
-        return image_cache[c_img_name]
+def decode_image(path: str, max_size: int) -> Image:
+    """
+    Decodes the image at ``path`` straight to a ``max_size`` square preview. JPEGs are decoded at a reduced scale by
+    the decoder itself, anything still much larger than the preview is shrunk by an integer factor before the final
+    LANCZOS resize, so large photos never go through a full resolution resample.
+    """
+    with Image.open(path) as img:
+        img.draft(None, (max_size, max_size))
 
-    c_img = Image.open(concept_image.path).resize(size=(max_size, max_size), resample=Image.Resampling.LANCZOS)
-    image_cache[c_img_name] = c_img
+        factor = min(img.width // max_size, img.height // max_size)
+        if factor >= 2 and img.mode not in ("1", "P"):
+            reduced = img.reduce(factor)
+        else:
+            img.load()
+            reduced = img
 
-    return c_img
+        return reduced.resize(size=(max_size, max_size), resample=Image.Resampling.LANCZOS)
 
 
-def load_concept_image(concept: Concept, image_cache: dict[str, Image], max_images: int, max_size: int) -> Image:
-    c_name = concept.canonical_name
-    if c_name in image_cache:
-        return image_cache[c_name]
-
-    concepts, concept_images = get_concept_child_hierarchy(concept)
+def select_concept_grid_images(concept: Concept, max_images: int) -> list[ConceptImage]:
+    """
+    Picks the images shown in the grid of ``concept``, the first few images of it and each of its descendants.
+    """
+    concepts, _ = get_concept_child_hierarchy(concept)
     concepts = [c for c in concepts if len(c.images) > 0]
 
+    if len(concepts) <= 0:
+        return []
+
     image_per_concept = max(round(max_images / len(concepts)), 1)
     selected_images = []
 
-    try:
-        for c in concepts:
-            c_img_len = len(c.images)
-            for i in range(min(image_per_concept, c_img_len)):
-                c_img = c.images[i]
-                c_img_canonical = c_img.get_canonical_name()
-
-                if c_img_canonical in image_cache:
-                    selected_images.append(image_cache[c_img_canonical])
-                else:
-                    loaded_image = load_image(c_img, image_cache, max_size)
-                    selected_images.append(loaded_image)
-
-                if len(selected_images) >= max_images:
-                    raise StopIteration
-    except StopIteration:
-        pass
+    for c in concepts:
+        selected_images.extend(c.images[:min(image_per_concept, max_images - len(selected_images))])
+        if len(selected_images) >= max_images:
+            break
 
-    concept_grid = create_image_grid(selected_images, max_size)
-    image_cache[c_name] = concept_grid
+    return selected_images
 
-    return concept_grid
 
+def get_concept_grid_key(concept: Concept, selected_images: list[ConceptImage]) -> str:
+    # keyed by the selected images as well, so adding or removing images below the concept renders a new grid
+    paths = "\0".join(c_img.path for c_img in selected_images)
+    return f"{concept.canonical_name}:{hashlib.blake2b(paths.encode('utf-8'), digest_size=16).hexdigest()}"
 
-def create_image_grid(images: list[Image], target_size: int = 512):
-    rows = math.sqrt(len(images))
-    rows = round(rows)
 
-    cols = math.ceil(len(images) / rows)
+def get_grid_layout(image_count: int, max_size: int) -> tuple[int, int]:
+    """
+    :return: the number of columns and the tile size of a square grid of ``image_count`` images
+    """
+    if image_count <= 0:
+        return 1, max_size
 
-    w, h = images[0].size
-    grid = Image.new('RGB', size=(cols * w, rows * h), color='black')
+    rows = max(round(math.sqrt(image_count)), 1)
+    columns = math.ceil(image_count / rows)
 
-    for i, img in enumerate(images):
-        grid.paste(img, box=(i % cols * w, i // cols * h))
+    return columns, max(max_size // max(rows, columns), 1)
 
-    w, h = grid.size
-    ratio = float(h) / float(w)
 
-    if w > h:
-        w = target_size
-        h = int(target_size * ratio)
-    elif w < h:
-        h = target_size
-        w = int(target_size * ratio)
-    else:
-        w = h = target_size
+def decode_tile(path: str, tile_size: int, thumbnail_cache=None) -> Image:
+    """
+    Decodes one grid tile, from the cached thumbnail when there is one and from the image itself otherwise.
+    """
+    try:
+        thumbnail = thumbnail_cache.load(path) if thumbnail_cache is not None else None
+        if thumbnail is not None:
+            return thumbnail.resize(size=(tile_size, tile_size), resample=Image.Resampling.LANCZOS)
 
-    if w != 512 or h != 512:
-        max_size = max(grid.size)
-        black_bg = Image.new("RGB", size=(max_size, max_size), color='black')
-        black_bg.paste(grid)
+        return decode_image(path, tile_size)
+    except (OSError, ValueError) as e:
+        print(f"\nWARNING: Unable to load image '{path}'. ({e})\n")
+        return Image.new("RGB", size=(tile_size, tile_size), color="black")
 
-        return black_bg.resize((target_size, target_size))
 
-    return grid.resize((w, h))
+def paste_tile(grid: Image, tile: Image, index: int, columns: int, tile_size: int):
+    grid.paste(tile, box=(index % columns * tile_size, index // columns * tile_size))
 
 
 def flatten_dataset(
@@ -93,7 +92,8 @@ def flatten_dataset(
         dataset_dst: str,
         concepts: dict[str, Concept],
         concept_images: dict[str, Image],
-        current_dataset_tags: dict[str, list[str]]
+        current_dataset_tags: dict[str, list[str]],
+        link_mode: LinkMode = LinkMode.COPY
 ):
     unique_prompts: list[str] = []
     unique_tags: list[str] = []
@@ -105,7 +105,7 @@ def flatten_dataset(
         concept_image = concept_images[c_img]
 
         tags, c_tags = get_image_tags(c_img, concepts, concept_images, current_dataset_tags)
-        special_tags = concept_image.concept.special_tags
+        expansions = concept_image.concept.get_special_expansions()
         tags = normalize_tags(c_tags + tags)
 
         filename = concept_image.get_filename(0)
@@ -114,8 +114,8 @@ def flatten_dataset(
         img_path = concept_image.path
         tags_file_path = os.path.join(dataset_dst, f"{filename}.txt")
 
-        shutil.copyfile(img_path, os.path.join(dataset_dst, f"{filename}{extension}"))
-        str_tags, tags = write_tags(tags_file_path, tags, special_tags)
+        link_file(img_path, os.path.join(dataset_dst, f"{filename}{extension}"), link_mode)
+        str_tags, tags = write_tags(tags_file_path, tags, expansions=expansions)
 
         captioned_image = CaptionedImage(concept_image.concept, img_path, tags)
         captioned_images.append(captioned_image)
@@ -142,27 +142,38 @@ def flatten_dataset(
 def save_dataset(
         concepts: [dict, Concept],
         concept_images: [dict, ConceptImage],
-        current_dataset_tags: dict[str, list[str]]
-) -> int:
-    touched = 0
-    for modified in current_dataset_tags:
+        current_dataset_tags: dict[str, list[str]],
+        keys: Iterable[str] | None = None
+) -> list[str]:
+    """
+    Writes the tags in ``current_dataset_tags`` of ``keys``, or of every entry, to their caption and prompt files and
+    updates the images and concepts in memory to match what was written, so the dataset needs no reload.
+
+    :return: the keys whose files were written
+    """
+    saved = []
+    for modified in (current_dataset_tags if keys is None else keys):
+        m_tags = current_dataset_tags.get(modified)
+        if m_tags is None or len(m_tags) <= 0:
+            continue
+
         if modified in concept_images:
             concept_image = concept_images[modified]
             parent_concept = concept_image.concept
-            special_tags = parent_concept.special_tags
 
-            m_tags = current_dataset_tags[modified]
-            if len(m_tags) > 0:
-                touched += 1
-                img_dir = parent_concept.working_directory
-                tags_txt_file = os.path.join(img_dir, f"{concept_image.get_filename(0)}.txt")
-                write_tags(tags_txt_file, m_tags, special_tags)
+            img_dir = parent_concept.working_directory
+            tags_txt_file = os.path.join(img_dir, f"{concept_image.get_filename(0)}.txt")
+            line, _ = write_tags(tags_txt_file, m_tags, expansions=parent_concept.get_special_expansions())
+
+            # same as reading the caption file back
+            concept_image.tags = normalize_tags(line.split(","))
+            concept_image.has_sidecar = True
+            saved.append(modified)
 
         elif modified in concepts:
             concept = concepts[modified]
             c_name = concept.name.replace("_", " ")
 
-            m_tags = current_dataset_tags[modified]
             r_tags = concept.raw_tags
 
             if "__folder__" in r_tags:
@@ -172,13 +183,14 @@ def save_dataset(
                         m_tags[mt_idx] = "__folder__"
                         break
 
-            if len(m_tags) > 0:
-                touched += 1
-                w_dir = concept.working_directory
-                tags_txt_file = os.path.join(w_dir, "__prompt.txt")
-                write_tags(tags_txt_file, m_tags)
+            w_dir = concept.working_directory
+            tags_txt_file = os.path.join(w_dir, "__prompt.txt")
+            line, _ = write_tags(tags_txt_file, m_tags)
+
+            concept.set_raw_tags(normalize_tags(line.split(",")))
+            saved.append(modified)
 
-    return touched
+    return saved
 
 
 def get_image_tags(
@@ -197,6 +209,63 @@ def get_image_tags(
     return normalize_tags(tags), normalize_tags(c_tags)
 
 
+def get_resolved_image_tags(
+        canonical_img: str,
+        concepts: dict[str, Concept],
+        concept_images: dict[str, Image],
+        current_dataset_tags: dict[str, list[str]]
+) -> list[str]:
+    """
+    The caption an image would be flattened with, including unsaved changes in ``current_dataset_tags``.
+    """
+    tags, c_tags = get_image_tags(canonical_img, concepts, concept_images, current_dataset_tags)
+    expansions = concept_images[canonical_img].concept.get_special_expansions()
+
+    return expand_special_tags(normalize_tags(c_tags + tags), expansions)
+
+
+def iter_resolved_concept_image_tags(
+        canonical_concept: str,
+        concepts: dict[str, Concept],
+        current_dataset_tags: dict[str, list[str]]
+) -> Iterator[tuple[str, list[str]]]:
+    """
+    ``get_resolved_image_tags`` of every image below a concept, including unsaved changes in ``current_dataset_tags``.
+    The tag prefix of each concept is resolved and expanded once from its parent's instead of walking the ancestors
+    and compiling the special tags again for every image.
+
+    :return: canonical image names and their resolved tags
+    """
+    concept_tags, parent_tags = get_concept_tags(canonical_concept, concepts, current_dataset_tags)
+
+    stack = [(concepts[canonical_concept], normalize_tags(parent_tags + concept_tags))]
+    while len(stack) > 0:
+        concept, prefix = stack.pop()
+
+        expansions = concept.get_special_expansions()
+        expanded = expand_special_tags(prefix, expansions)
+        expanded_set = set(expanded)
+
+        for img in concept.images:
+            canonical_img = img.get_canonical_name()
+            img_tags = current_dataset_tags.get(canonical_img)
+
+            tags = expanded[:]
+            seen = set(expanded_set)
+
+            for t in (img.tags if img_tags is None else img_tags):
+                for r in expansions.get(t.strip(), (t.strip(),)):
+                    if len(r) > 0 and r not in seen:
+                        seen.add(r)
+                        tags.append(r)
+
+            yield canonical_img, tags
+
+        for child in concept.children:
+            child_tags = current_dataset_tags.get(child.canonical_name)
+            stack.append((child, normalize_tags(prefix + (child.concept_tags if child_tags is None else child_tags))))
+
+
 def get_concept_tags(
         canonical_concept: str,
         concepts: dict[str, Concept],
@@ -0,0 +1,151 @@
+import queue
+import threading
+import tkinter as tk
+from collections.abc import Callable
+
+from fking.fking_cache import ScanManifest
+from fking.fking_captions import Concept, create_concept
+from fking.fking_index import TagIndex
+
+
+class DatasetLoader:
+    """
+    Scans a dataset on a background thread so opening a large one never blocks the Tk main loop.
+
+    Concepts are handed back as the scan discovers them, through a queue that is drained on the main thread with
+    ``root.after`` in batches of at most ``batch_size``, so the tree fills in while the scan runs. The tag index of the
+    finished tree is built on the scanning thread as well. Tk is only ever touched from the main thread.
+    """
+
+    def __init__(self, root: tk.Tk, poll_interval: int = 50, batch_size: int = 500):
+        self.root = root
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+
+        self.directories = 0
+        self.images = 0
+
+        self.__results: queue.SimpleQueue[tuple[int, str, object]] = queue.SimpleQueue()
+        self.__cancel_event: threading.Event | None = None
+        self.__generation = 0
+
+        self.__on_concepts: Callable[[list[Concept]], None] | None = None
+        self.__on_complete: Callable[[Concept | None, TagIndex | None], None] | None = None
+
+        self.__poll_id: str | None = None
+
+    def is_loading(self) -> bool:
+        return self.__cancel_event is not None
+
+    def load(
+            self,
+            directory: str,
+            on_concepts: Callable[[list[Concept]], None],
+            on_complete: Callable[[Concept | None, TagIndex | None], None]
+    ):
+        """
+        Starts scanning ``directory``, abandoning any scan still running. ``on_concepts`` is called on the main thread
+        with each batch of discovered concepts, parents before their children, and ``on_complete`` with the root
+        concept and its tag index once the scan is done, or with ``None`` when it was cancelled or failed.
+        """
+        self.cancel()
+
+        self.__generation += 1
+        self.__cancel_event = threading.Event()
+        self.__on_concepts = on_concepts
+        self.__on_complete = on_complete
+
+        self.directories = 0
+        self.images = 0
+
+        threading.Thread(
+                target=self.__scan,
+                args=(self.__generation, directory, self.__cancel_event),
+                name="fking-dataset-loader",
+                daemon=True
+        ).start()
+
+        self.__schedule_poll()
+
+    def cancel(self):
+        """
+        Stops the running scan, its ``on_complete`` is called with ``None`` right away.
+        """
+        if self.__cancel_event is None:
+            return
+
+        self.__cancel_event.set()
+        self.__finish(None, None)
+
+    def __scan(self, generation: int, directory: str, cancel_event: threading.Event):
+        try:
+            manifest = ScanManifest(directory)
+            concept = create_concept(
+                    "global",
+                    directory,
+                    manifest=manifest,
+                    progress=lambda c: self.__results.put((generation, "concept", c)),
+                    cancel_event=cancel_event
+            )
+
+            # a cancelled scan did not visit every directory, pruning would drop the entries it never reached
+            manifest.save(prune=concept is not None)
+
+            tag_index = None
+            if concept is not None and not cancel_event.is_set():
+                tag_index = TagIndex.from_captioned_images(concept.iter_flatten())
+
+            self.__results.put((generation, "complete", (concept, tag_index)))
+        except BaseException as e:
+            self.__results.put((generation, "error", e))
+
+    def __schedule_poll(self):
+        if self.__poll_id is None:
+            self.__poll_id = self.root.after(self.poll_interval, self.__poll)
+
+    def __poll(self):
+        self.__poll_id = None
+
+        batch: list[Concept] = []
+        result = None
+
+        while len(batch) < self.batch_size:
+            try:
+                generation, kind, value = self.__results.get_nowait()
+            except queue.Empty:
+                break
+
+            # left over from a cancelled scan
+            if generation != self.__generation or self.__cancel_event is None:
+                continue
+
+            if kind == "concept":
+                batch.append(value)
+                self.directories += 1
+                self.images += len(value.images)
+            else:
+                result = kind, value
+                break
+
+        if len(batch) > 0:
+            self.__on_concepts(batch)
+
+        if result is not None:
+            kind, value = result
+            if kind == "error":
+                print(f"\nWARNING: Unable to load dataset. ({value})\n")
+                self.__finish(None, None)
+            else:
+                self.__finish(*value)
+
+        if self.__cancel_event is not None:
+            self.__schedule_poll()
+
+    def __finish(self, concept: Concept | None, tag_index: TagIndex | None):
+        on_complete = self.__on_complete
+
+        self.__cancel_event = None
+        self.__on_concepts = None
+        self.__on_complete = None
+
+        on_complete(concept, tag_index)
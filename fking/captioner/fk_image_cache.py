@@ -0,0 +1,92 @@
+from collections import OrderedDict
+
+from PIL import Image
+
+# bytes per pixel of the modes previews and grids end up in, anything else is counted per band
+__mode_bytes = {"1": 1, "L": 1, "P": 1, "LA": 4, "RGB": 4, "RGBA": 4, "CMYK": 4, "YCbCr": 4, "I": 4, "F": 4}
+
+
+class ImageCache:
+    """
+    LRU cache of decoded images with a byte budget, the size of an image is estimated from its dimensions and mode.
+
+    Reading an image marks it as most recently used, adding one evicts the least recently used images until the cache
+    fits its budget again. An image larger than the whole budget is not cached at all.
+    """
+
+    def __init__(self, max_bytes: int, name: str = "images"):
+        self.max_bytes = max_bytes
+        self.name = name
+
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.__images: OrderedDict[str, tuple[Image.Image, int]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.__images)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.__images
+
+    def __getitem__(self, key: str) -> Image.Image:
+        image = self.get(key)
+        if image is None:
+            raise KeyError(key)
+
+        return image
+
+    def __setitem__(self, key: str, image: Image.Image):
+        self.pop(key)
+
+        image_size = get_image_size(image)
+        if image_size > self.max_bytes:
+            return
+
+        self.__images[key] = image, image_size
+        self.size += image_size
+
+        while self.size > self.max_bytes:
+            _, (_, evicted_size) = self.__images.popitem(last=False)
+            self.size -= evicted_size
+            self.evictions += 1
+
+    def get(self, key: str) -> Image.Image | None:
+        entry = self.__images.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.__images.move_to_end(key)
+        return entry[0]
+
+    def pop(self, key: str) -> Image.Image | None:
+        entry = self.__images.pop(key, None)
+        if entry is None:
+            return None
+
+        self.size -= entry[1]
+        return entry[0]
+
+    def clear(self):
+        self.__images.clear()
+        self.size = 0
+
+    def get_stats(self) -> str:
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups > 0 else 0.0
+
+        return (f"{self.name}: {len(self.__images):,} cached, {self.size / 2 ** 20:,.1f} of "
+                f"{self.max_bytes / 2 ** 20:,.1f} MiB, {self.hits:,} hits, {self.misses:,} misses "
+                f"({hit_rate:.1%} hit rate), {self.evictions:,} evictions")
+
+
+def get_image_size(image: Image.Image) -> int:
+    mode_bytes = __mode_bytes.get(image.mode)
+    if mode_bytes is None:
+        mode_bytes = len(image.getbands())
+
+    return image.width * image.height * mode_bytes
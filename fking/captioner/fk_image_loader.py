@@ -0,0 +1,284 @@
+import queue
+import tkinter as tk
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from PIL import Image
+
+from fking.captioner.fk_captioning_utils import decode_image, decode_tile, get_concept_grid_key, get_grid_layout, \
+    paste_tile, select_concept_grid_images
+from fking.captioner.fk_image_cache import ImageCache
+from fking.captioner.fk_thumbnail_cache import ThumbnailCache
+from fking.fking_captions import Concept, ConceptImage
+
+
+class ImageLoader:
+    """
+    Decodes preview images on a background thread pool so the Tk main loop never waits on an image.
+
+    Finished previews are handed back through a queue that is drained on the main thread with ``root.after``, where
+    they are put into ``image_cache`` and passed to the callbacks waiting for them. Concept grids are decoded tile by
+    tile on a pool of their own, so a grid never holds up previews, and are pasted together on the main thread as the
+    tiles arrive. Tk is only ever touched from the main thread.
+    """
+
+    def __init__(
+            self,
+            root: tk.Tk,
+            image_cache: ImageCache,
+            max_size: int,
+            max_workers: int = 4,
+            poll_interval: int = 15
+    ):
+        self.root = root
+        self.image_cache = image_cache
+        self.max_size = max_size
+        self.poll_interval = poll_interval
+
+        # thumbnails of the open dataset, read before decoding and written after
+        self.thumbnail_cache: ThumbnailCache | None = None
+
+        self.__executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="fking-image-loader")
+        self.__results: queue.SimpleQueue[tuple[str, Image.Image | None, BaseException | None]] = queue.SimpleQueue()
+
+        self.__pending: dict[str, Future] = {}
+        self.__callbacks: dict[str, list[Callable[[ConceptImage, Image], None]]] = {}
+        self.__images: dict[str, ConceptImage] = {}
+
+        self.__grid_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="fking-grid-loader")
+        self.__tiles: queue.SimpleQueue[tuple[int, int, Image.Image]] = queue.SimpleQueue()
+
+        self.__grid: _GridJob | None = None
+        self.__grid_generation = 0
+
+        self.__poll_id: str | None = None
+
+    def load(self, concept_image: ConceptImage, callback: Callable[[ConceptImage, Image], None]):
+        """
+        Calls ``callback`` with the preview of ``concept_image`` on the main thread, right away when it is cached.
+        """
+        c_img_name = concept_image.get_canonical_name()
+
+        image = self.image_cache.get(c_img_name)
+        if image is not None:
+            callback(concept_image, image)
+            return
+
+        self.__callbacks.setdefault(c_img_name, []).append(callback)
+        self.__submit(concept_image)
+
+    def prefetch(self, concept_images: list[ConceptImage]):
+        """
+        Starts decoding ``concept_images`` in the background. Prefetches that were not started yet and are no longer
+        wanted are cancelled, so skipping ahead quickly never builds up a backlog.
+        """
+        wanted = {c_img.get_canonical_name() for c_img in concept_images}
+
+        for c_img_name, future in list(self.__pending.items()):
+            if c_img_name not in wanted and c_img_name not in self.__callbacks and future.cancel():
+                del self.__pending[c_img_name]
+                del self.__images[c_img_name]
+
+        for c_img in concept_images:
+            if c_img.get_canonical_name() not in self.image_cache:
+                self.__submit(c_img)
+
+    def load_grid(
+            self,
+            concept: Concept,
+            grid_cache: ImageCache,
+            max_images: int,
+            callback: Callable[[Concept, Image, bool], None]
+    ):
+        """
+        Renders the preview grid of ``concept``. ``callback`` is called on the main thread with the partly filled grid
+        as tiles arrive, and with ``True`` once the grid is complete and cached. Starting another grid abandons the
+        previous one.
+        """
+        self.__cancel_grid()
+
+        selected_images = select_concept_grid_images(concept, max_images)
+        grid_key = get_concept_grid_key(concept, selected_images)
+
+        concept_grid = grid_cache.get(grid_key)
+        if concept_grid is not None:
+            callback(concept, concept_grid, True)
+            return
+
+        columns, tile_size = get_grid_layout(len(selected_images), self.max_size)
+        grid = _GridJob(
+                self.__grid_generation,
+                concept,
+                grid_key,
+                grid_cache,
+                columns,
+                tile_size,
+                Image.new("RGB", size=(self.max_size, self.max_size), color="black"),
+                len(selected_images),
+                callback
+        )
+
+        if grid.remaining <= 0:
+            grid_cache[grid_key] = grid.image
+            callback(concept, grid.image, True)
+            return
+
+        grid.futures = [
+            self.__grid_executor.submit(self.__decode_tile, grid.generation, i, c_img.path, tile_size,
+                                        self.thumbnail_cache)
+            for i, c_img in enumerate(selected_images)
+        ]
+
+        self.__grid = grid
+        self.__schedule_poll()
+
+    def clear(self):
+        self.__cancel_grid()
+
+        for future in self.__pending.values():
+            future.cancel()
+
+        self.__pending.clear()
+        self.__callbacks.clear()
+        self.__images.clear()
+
+    def __submit(self, concept_image: ConceptImage):
+        c_img_name = concept_image.get_canonical_name()
+        if c_img_name in self.__pending:
+            return
+
+        self.__images[c_img_name] = concept_image
+        self.__pending[c_img_name] = self.__executor.submit(
+                self.__decode,
+                c_img_name,
+                concept_image.path,
+                self.thumbnail_cache
+        )
+
+        self.__schedule_poll()
+
+    def __schedule_poll(self):
+        if self.__poll_id is None:
+            self.__poll_id = self.root.after(self.poll_interval, self.__poll)
+
+    def __cancel_grid(self):
+        self.__grid_generation += 1
+
+        if self.__grid is not None:
+            for future in self.__grid.futures:
+                future.cancel()
+
+            self.__grid = None
+
+    def __decode_tile(self, generation: int, index: int, path: str, tile_size: int,
+                      thumbnail_cache: ThumbnailCache | None):
+        # a grid that was abandoned while this tile waited in the queue is not worth decoding
+        if generation != self.__grid_generation:
+            return
+
+        # a tile is queued whatever happens, the grid only completes once every one of them arrived
+        try:
+            tile = decode_tile(path, tile_size, thumbnail_cache)
+        except Exception as e:
+            print(f"\nWARNING: Unable to load image '{path}'. ({e})\n")
+            tile = Image.new("RGB", size=(tile_size, tile_size), color="black")
+
+        self.__tiles.put((generation, index, tile))
+
+    def __decode(self, c_img_name: str, path: str, thumbnail_cache: ThumbnailCache | None):
+        try:
+            if thumbnail_cache is not None and thumbnail_cache.max_size == self.max_size:
+                image = thumbnail_cache.load_or_decode(path)
+            else:
+                image = decode_image(path, self.max_size)
+
+            self.__results.put((c_img_name, image, None))
+        except BaseException as e:
+            self.__results.put((c_img_name, None, e))
+
+    def __poll(self):
+        self.__poll_id = None
+
+        while True:
+            try:
+                c_img_name, image, error = self.__results.get_nowait()
+            except queue.Empty:
+                break
+
+            # cleared or cancelled while decoding
+            if self.__pending.pop(c_img_name, None) is None:
+                continue
+
+            concept_image = self.__images.pop(c_img_name)
+            callbacks = self.__callbacks.pop(c_img_name, [])
+
+            if error is not None:
+                print(f"\nWARNING: Unable to load image '{concept_image.path}'. ({error})\n")
+                continue
+
+            self.image_cache[c_img_name] = image
+            for callback in callbacks:
+                callback(concept_image, image)
+
+        self.__poll_tiles()
+
+        if len(self.__pending) > 0 or self.__grid is not None:
+            self.__schedule_poll()
+
+    def __poll_tiles(self):
+        grid = self.__grid
+        pasted = False
+
+        while True:
+            try:
+                generation, index, tile = self.__tiles.get_nowait()
+            except queue.Empty:
+                break
+
+            if grid is None or generation != grid.generation:
+                continue
+
+            paste_tile(grid.image, tile, index, grid.columns, grid.tile_size)
+            grid.remaining -= 1
+            pasted = True
+
+        if not pasted:
+            return
+
+        if grid.remaining > 0:
+            grid.callback(grid.concept, grid.image, False)
+            return
+
+        self.__grid = None
+        grid.grid_cache[grid.key] = grid.image
+        grid.callback(grid.concept, grid.image, True)
+
+
+class _GridJob:
+    __slots__ = (
+        "generation", "concept", "key", "grid_cache", "columns", "tile_size", "image", "remaining", "callback",
+        "futures"
+    )
+
+    def __init__(
+            self,
+            generation: int,
+            concept: Concept,
+            key: str,
+            grid_cache: ImageCache,
+            columns: int,
+            tile_size: int,
+            image: Image.Image,
+            remaining: int,
+            callback: Callable[[Concept, Image, bool], None]
+    ):
+        self.generation = generation
+        self.concept = concept
+        self.key = key
+        self.grid_cache = grid_cache
+        self.columns = columns
+        self.tile_size = tile_size
+        self.image = image
+        self.remaining = remaining
+        self.callback = callback
+        self.futures: list[Future] = []
@@ -0,0 +1,96 @@
+import bisect
+
+
+class NavigationIndex:
+    """
+    Images of the open dataset in tree order, for moving through them one at a time.
+
+    Images are kept as an ordered list of ids with an id to position map, so stepping to a neighbour is constant
+    time. Untagged (no caption file and no pending tags) and modified images are kept as sorted lists of positions,
+    updated as images are edited, so jumping to the next one of either is a binary search.
+    """
+
+    def __init__(self):
+        self.keys: list[str] = []
+
+        self.__positions: dict[str, int] = {}
+        self.__untagged: list[int] = []
+        self.__modified: list[int] = []
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.__positions
+
+    def append(self, key: str, untagged: bool = False):
+        position = len(self.keys)
+
+        self.keys.append(key)
+        self.__positions[key] = position
+
+        if untagged:
+            self.__untagged.append(position)
+
+    def clear(self):
+        self.keys.clear()
+        self.__positions.clear()
+        self.__untagged.clear()
+        self.__modified.clear()
+
+    def get_position(self, key: str) -> int | None:
+        return self.__positions.get(key)
+
+    def get_next(self, key: str, step: int = 1) -> str | None:
+        """
+        :return: the image ``step`` positions after ``key``, negative steps go back, None past either end
+        """
+        position = self.__positions.get(key)
+        if position is None:
+            return None
+
+        position += step
+        return self.keys[position] if 0 <= position < len(self.keys) else None
+
+    def get_next_untagged(self, key: str | None) -> str | None:
+        return self.__get_next_in(self.__untagged, key)
+
+    def get_next_modified(self, key: str | None) -> str | None:
+        return self.__get_next_in(self.__modified, key)
+
+    def count_untagged(self) -> int:
+        return len(self.__untagged)
+
+    def count_modified(self) -> int:
+        return len(self.__modified)
+
+    def set_untagged(self, key: str, untagged: bool):
+        self.__set_flag(self.__untagged, key, untagged)
+
+    def set_modified(self, key: str, modified: bool):
+        self.__set_flag(self.__modified, key, modified)
+
+    def __set_flag(self, positions: list[int], key: str, flag: bool):
+        position = self.__positions.get(key)
+        if position is None:
+            return
+
+        i = bisect.bisect_left(positions, position)
+        present = i < len(positions) and positions[i] == position
+
+        if flag and not present:
+            positions.insert(i, position)
+        elif not flag and present:
+            del positions[i]
+
+    def __get_next_in(self, positions: list[int], key: str | None) -> str | None:
+        """
+        The first image in ``positions`` after ``key``, wrapping around to the start.
+        """
+        if len(positions) <= 0:
+            return None
+
+        position = self.__positions.get(key, -1) if key is not None else -1
+
+        i = bisect.bisect_right(positions, position)
+        return self.keys[positions[i if i < len(positions) else 0]]
@@ -0,0 +1,94 @@
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, features
+
+from fking.captioner.fk_captioning_utils import decode_image
+from fking.fking_cache import atomic_replace, get_cache_directory, get_dataset_key
+
+default_thumbnail_size = 604
+
+
+class ThumbnailCache:
+    """
+    Preview-size thumbnails of dataset images, stored in ``<dataset>/.fking_cache/thumbs/<size>``.
+
+    A thumbnail is keyed by the image's path relative to the dataset root, its size and its mtime, so an edited image
+    simply misses and gets a new thumbnail. Thumbnails are WebP where Pillow supports it and JPEG otherwise, written
+    to a temporary file and renamed into place so concurrent generators never expose partial files.
+    """
+
+    def __init__(self, dataset_root: str, max_size: int = default_thumbnail_size):
+        self.dataset_root = dataset_root
+        self.max_size = max_size
+        self.directory = os.path.join(get_cache_directory(dataset_root, create=False), "thumbs", str(max_size))
+
+        self.__format, self.__extension = ("WEBP", ".webp") if features.check("webp") else ("JPEG", ".jpg")
+
+    def get_path(self, path: str, stat: os.stat_result | None = None) -> str:
+        if stat is None:
+            stat = os.stat(path)
+
+        key = f"{get_dataset_key(self.dataset_root, path)}\0{stat.st_size}\0{stat.st_mtime_ns}"
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
+
+        return os.path.join(self.directory, digest[:2], f"{digest}{self.__extension}")
+
+    def load(self, path: str) -> Image.Image | None:
+        try:
+            with Image.open(self.get_path(path)) as thumbnail:
+                thumbnail.load()
+                return thumbnail
+        except (OSError, ValueError):
+            return None
+
+    def save(self, path: str, image: Image.Image):
+        thumbnail_path = self.get_path(path)
+        os.makedirs(os.path.dirname(thumbnail_path), exist_ok=True)
+
+        if self.__format == "JPEG" and image.mode != "RGB":
+            image = image.convert("RGB")
+
+        try:
+            with atomic_replace(thumbnail_path) as tmp_path:
+                image.save(tmp_path, self.__format, quality=90)
+        except OSError as e:
+            print(f"\nWARNING: Unable to cache thumbnail of '{path}'. ({e})\n")
+
+    def load_or_decode(self, path: str) -> Image.Image:
+        """
+        The cached thumbnail of ``path``, decoding and caching it first on a miss.
+        """
+        thumbnail = self.load(path)
+        if thumbnail is None:
+            thumbnail = decode_image(path, self.max_size)
+            self.save(path, thumbnail)
+
+        return thumbnail
+
+    def generate(self, paths: list[str], max_workers: int | None = None) -> int:
+        """
+        Generates the thumbnails of ``paths`` that are missing on a process pool.
+
+        :return: the number of thumbnails generated
+        """
+        missing = [p for p in paths if not os.path.exists(self.get_path(p))]
+        if len(missing) <= 0:
+            return 0
+
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            jobs = [(self.dataset_root, self.max_size, p) for p in missing]
+            return sum(executor.map(_generate_thumbnail, jobs, chunksize=16))
+
+
+def _generate_thumbnail(args: tuple[str, int, str]) -> bool:
+    dataset_root, max_size, path = args
+
+    try:
+        ThumbnailCache(dataset_root, max_size).save(path, decode_image(path, max_size))
+    except (OSError, ValueError) as e:
+        print(f"\nWARNING: Unable to generate thumbnail of '{path}'. ({e})\n")
+        return False
+
+    return True
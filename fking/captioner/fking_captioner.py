@@ -3,15 +3,20 @@ import shutil
 import sys
 import tkinter
 import tkinter as tk
-from functools import cmp_to_key
 from tkinter import filedialog, messagebox, ttk
 
 from PIL import Image, ImageTk
 
-from fking.captioner.fk_captioning_utils import flatten_dataset, get_concept_tags, get_image_tags, load_concept_image, \
-    load_image, save_dataset
-from fking.fking_captions import Concept, ConceptImage, create_concept
-from fking.fking_utils import is_image, normalize_tags
+from fking.captioner.fk_captioning_utils import flatten_dataset, get_concept_tags, get_image_tags, \
+    get_resolved_image_tags, iter_resolved_concept_image_tags, save_dataset
+from fking.captioner.fk_dataset_loader import DatasetLoader
+from fking.captioner.fk_image_cache import ImageCache
+from fking.captioner.fk_image_loader import ImageLoader
+from fking.captioner.fk_navigation import NavigationIndex
+from fking.captioner.fk_thumbnail_cache import ThumbnailCache
+from fking.fking_captions import Concept, ConceptImage
+from fking.fking_index import TagIndex
+from fking.fking_utils import LinkMode, natural_sorted, normalize_tags
 
 root = tk.Tk()
 
@@ -34,10 +39,12 @@ working_concept: Concept | None = None
 
 concepts: dict[str, Concept] = {}
 concept_images: dict[str, ConceptImage] = {}
-sorted_concept_images: dict[str, ConceptImage] = {}
-image_cache: dict[str, Image] = {}
+navigation_index = NavigationIndex()  # images in tree order, with the untagged and modified ones to jump between
+image_cache = ImageCache(256 * 2 ** 20, "previews")
+grid_cache = ImageCache(64 * 2 ** 20, "concept grids")
 
 current_dataset_tags: dict[str, list[str]] = {}
+dirty_items: set[str] = set()  # images and concepts whose tags in current_dataset_tags differ from their files
 
 last_modified_tags: list[str] = []
 
@@ -45,14 +52,28 @@ image_preview_size = 604
 transparent_img = ImageTk.PhotoImage(Image.new("RGBA", (image_preview_size, image_preview_size), (0, 0, 0, 0)))
 active_img: None | ImageTk.PhotoImage = transparent_img
 
+image_loader = ImageLoader(root, image_cache, image_preview_size)
+thumbnail_cache: ThumbnailCache | None = None
+prefetch_count = 4  # images after the selected one decoded ahead of time
+
 max_load_concept_images = 100  # 10x10 image grid
 active_concept_image: ConceptImage | None = None
+active_concept: Concept | None = None
 
 active_parent_tags: list[str] = []
 active_img_tags: list[str] = []
 
 active_title_fragment = None
 
+tag_index: TagIndex | None = None
+tree_concept_images: dict[str, list[str]] = {}  # concept iid to its image iids, in tree order
+populated_concepts: set[str] = set()  # concepts whose image rows were inserted, others hold a placeholder row
+filtered_images: set[str] | None = None  # images matching the tree filter, None when not filtering
+filter_after_id: str | None = None
+concept_row_children: dict[str, list[Concept]] = {}  # concept iid to its child concepts inserted so far
+
+dataset_loader = DatasetLoader(root)
+
 
 def on_menu_item_open(event=None):
     global working_concept, working_directory
@@ -91,7 +112,14 @@ def on_menu_item_flatten(event=None):
 
             return
 
-    flattened_images = flatten_dataset(dst_directory, dataset_directory, concepts, concept_images, current_dataset_tags)
+    flattened_images = flatten_dataset(
+            dst_directory,
+            dataset_directory,
+            concepts,
+            concept_images,
+            current_dataset_tags,
+            LinkMode(flatten_link_mode.get())
+    )
     flattened_images_len = len(flattened_images)
     del flattened_images
 
@@ -128,6 +156,10 @@ def on_tree_view_child_click(event):
         __set_active_concept(tree_sel)
 
 
+def on_tree_view_open(event):
+    __populate_concept(treeview_concept.focus())
+
+
 def on_apply_button(event):
     global last_modified_tags
 
@@ -138,47 +170,53 @@ def on_apply_button(event):
     tree_sel = tree_selection[0]
     tags = __tags_from_text_field()
 
-    current_dataset_tags[tree_sel] = tags
     last_modified_tags = tags
 
+    saved_tags = __get_saved_tags(tree_sel)
+    previous_tags = current_dataset_tags.get(tree_sel, saved_tags)
+
+    # applying the tags a file already has, e.g. when stepping through images, leaves nothing to save
+    if tags == saved_tags:
+        current_dataset_tags.pop(tree_sel, None)
+    else:
+        current_dataset_tags[tree_sel] = tags
+
+    __set_dirty(tree_sel, tree_sel in current_dataset_tags and len(tags) > 0)
+
+    if tree_sel in concept_images:
+        navigation_index.set_untagged(tree_sel, not concept_images[tree_sel].has_sidecar and len(tags) <= 0)
+
+    # the resolved captions only change with the tags, re-indexing a whole concept is not free
+    if tags != previous_tags:
+        __update_tag_index(tree_sel)
+
     __set_title(active_title_fragment)
 
 
-def on_next_button(event):
-    def get_canonical_index(canonical_str, search: dict) -> int:
-        keys = search.keys()
-        index = -1
+def on_next_button(event=None):
+    __navigate(lambda key: __get_next_visible(key, 1))
 
-        for k in keys:
-            index = index + 1
-            if k == canonical_str:
-                return index
 
-        return index
+def on_previous_button(event=None):
+    __navigate(lambda key: __get_next_visible(key, -1))
 
-    def get_canonical_from_index(index: int, search: dict) -> str:
-        keys = list(search.keys())
-        return keys[index]
 
-    on_apply_button(event)
+def on_next_untagged(event=None):
+    __navigate(navigation_index.get_next_untagged)
 
-    tree_sel = treeview_concept.selection()
-    if len(tree_sel) <= 0:
-        return
 
-    tree_sel = tree_sel[0]
-    can_idx = get_canonical_index(tree_sel, sorted_concept_images)
-    if can_idx <= -1:
-        return
+def on_next_modified(event=None):
+    __navigate(navigation_index.get_next_modified)
 
-    next_idx = can_idx + 1
 
-    if next_idx < len(sorted_concept_images):
-        next_id = get_canonical_from_index(next_idx, sorted_concept_images)
-        if next_id is not None:
-            __open_tree_item(next_id)
+def on_filter_changed(event=None):
+    global filter_after_id
 
-    text_image_tags_field.focus_force()
+    # debounced, so typing a query re-filters the tree once rather than on every key
+    if filter_after_id is not None:
+        root.after_cancel(filter_after_id)
+
+    filter_after_id = root.after(200, __apply_tree_filter)
 
 
 def on_paste_button(event=None):
@@ -186,6 +224,11 @@ def on_paste_button(event=None):
         __set_tags_text(last_modified_tags, active_parent_tags)
 
 
+def on_menu_item_cache_stats(event=None):
+    print(image_cache.get_stats())
+    print(grid_cache.get_stats())
+
+
 def on_request_exit(event=None):
     nl = '\n'
     if working_concept is None or messagebox.askyesno(
@@ -197,16 +240,150 @@ def on_request_exit(event=None):
 
 
 def __is_modified() -> bool:
-    for key in current_dataset_tags.keys():
-        value = current_dataset_tags[key]
-        if value is not None and len(value) > 0:
-            return True
+    return len(dirty_items) > 0
+
+
+def __get_saved_tags(iid: str) -> list[str] | None:
+    if iid in concept_images:
+        return normalize_tags(concept_images[iid].tags)
+
+    if iid in concepts:
+        return normalize_tags(concepts[iid].concept_tags)
+
+    return None
+
+
+def __set_dirty(iid: str, dirty: bool):
+    if dirty:
+        dirty_items.add(iid)
+    else:
+        dirty_items.discard(iid)
+
+    if iid in concept_images:
+        navigation_index.set_modified(iid, dirty)
+
+    if treeview_concept.exists(iid):
+        treeview_concept.item(iid, tags=("modified",) if dirty else ())
+
+
+def __navigate(get_next):
+    """
+    Applies the pending tags of the selection and opens the image ``get_next`` finds from it.
+    """
+    if working_concept is None:
+        return
+
+    on_apply_button(None)
+
+    tree_sel = treeview_concept.selection()
+    next_id = get_next(tree_sel[0] if len(tree_sel) > 0 else None)
+
+    if next_id is not None:
+        __open_tree_item(next_id)
+
+    text_image_tags_field.focus_force()
+
+
+def __get_next_visible(key: str | None, step: int) -> str | None:
+    if key is None or key not in navigation_index:
+        return None
+
+    # skip over images hidden by the tree filter
+    next_id = navigation_index.get_next(key, step)
+    while next_id is not None and filtered_images is not None and next_id not in filtered_images:
+        next_id = navigation_index.get_next(next_id, step)
+
+    return next_id
+
+
+def __update_tag_index(iid: str):
+    """
+    Re-indexes the images whose resolved captions depend on the tags of ``iid``, the image itself or every image
+    below the concept.
+    """
+    if tag_index is None:
+        return
+
+    if iid in concept_images:
+        tag_index.update(iid, get_resolved_image_tags(iid, concepts, concept_images, current_dataset_tags))
+    elif iid in concepts:
+        for canonical_img, tags in iter_resolved_concept_image_tags(iid, concepts, current_dataset_tags):
+            tag_index.update(canonical_img, tags)
+    else:
+        return
+
+    if filtered_images is not None:
+        __apply_tree_filter()
+
+
+def __apply_tree_filter():
+    global filter_after_id, filtered_images
+
+    filter_after_id = None
+    expression = entry_filter.get().strip()
+
+    if tag_index is None or len(expression) <= 0:
+        filtered = None
+    else:
+        try:
+            filtered = set(tag_index.query_keys(expression))
+        except ValueError:
+            entry_filter.config(fg="red")
+            return
+
+    entry_filter.config(fg="black")
+
+    if filtered is None and filtered_images is None:
+        return
+
+    filtered_images = filtered
+
+    # concepts that were never opened are filtered when their rows are inserted
+    for concept_iid in populated_concepts:
+        __filter_concept_images(concept_iid)
+
+
+def __filter_concept_images(concept_iid: str):
+    image_iids = tree_concept_images.get(concept_iid)
+    if image_iids is None:
+        return
+
+    # images are re-attached after the concept's child concepts, same order they were inserted in
+    child_concepts = [iid for iid in treeview_concept.get_children(concept_iid) if iid in concepts]
+    visible_images = image_iids if filtered_images is None else [iid for iid in image_iids if iid in filtered_images]
+
+    treeview_concept.set_children(concept_iid, *child_concepts, *visible_images)
+
 
-    return False
+def __get_placeholder_iid(concept_iid: str) -> str:
+    return f"__placeholder__:{concept_iid}"
+
+
+def __populate_concept(concept_iid: str):
+    """
+    Inserts the image rows of a concept the first time it is opened, until then it only holds a placeholder row so it
+    can be expanded.
+    """
+    if concept_iid in populated_concepts or concept_iid not in concepts:
+        return
+
+    populated_concepts.add(concept_iid)
+
+    image_iids = tree_concept_images.get(concept_iid)
+    if image_iids is None:
+        return
+
+    treeview_concept.delete(__get_placeholder_iid(concept_iid))
+    for iid in image_iids:
+        treeview_concept.insert(concept_iid, tk.END, iid, text=concept_images[iid].get_filename(),
+                                tags=("modified",) if iid in dirty_items else ())
+
+    if filtered_images is not None:
+        __filter_concept_images(concept_iid)
 
 
 def __set_active_image(canonical_img: str):
-    global active_img, active_img_tags, active_concept_image, active_parent_tags
+    global active_img, active_img_tags, active_concept_image, active_parent_tags, active_concept
 
     if canonical_img is None:
         del active_img
@@ -216,6 +393,7 @@ def __set_active_image(canonical_img: str):
         return
 
     active_concept_image = concept_images[canonical_img]
+    active_concept = None
     image_concept = active_concept_image.concept
     concept_raw_tags = image_concept.raw_tags
 
@@ -224,25 +402,44 @@ def __set_active_image(canonical_img: str):
     active_img_tags, active_parent_tags = get_image_tags(canonical_img, concepts, concept_images, current_dataset_tags)
     __set_tags_text(active_img_tags, active_parent_tags)
 
-    image = load_image(active_concept_image, image_cache, image_preview_size)
-    img_tk = ImageTk.PhotoImage(image)
-    active_img = img_tk
-
+    # the preview is decoded in the background, until it arrives the previous one must not stay on screen
+    active_img = transparent_img
     label_image_preview['image'] = active_img
+    image_loader.load(active_concept_image, __on_preview_loaded)
+
+    position = navigation_index.get_position(canonical_img)
+    if position is not None:
+        image_loader.prefetch([
+            concept_images[k] for k in navigation_index.keys[position + 1:position + 1 + prefetch_count]
+        ])
+
     __set_title(f"'{os.path.relpath(active_concept_image.path, working_directory)}'")
 
 
+def __on_preview_loaded(concept_image: ConceptImage, image: Image):
+    global active_img
+
+    # the selection moved on while this image was decoding
+    if concept_image is not active_concept_image:
+        return
+
+    active_img = ImageTk.PhotoImage(image)
+    label_image_preview['image'] = active_img
+
+
 def __set_active_concept(canonical_concept: str):
-    global active_img_tags, active_parent_tags, active_img, active_concept_image
+    global active_img_tags, active_parent_tags, active_img, active_concept_image, active_concept
 
     active_img_tags = None
     active_concept_image = None
 
     target_concept = concepts[canonical_concept]
-    concept_grid = load_concept_image(target_concept, image_cache, max_load_concept_images, image_preview_size)
+    active_concept = target_concept
 
-    active_img = ImageTk.PhotoImage(concept_grid)
+    # tiles fill in as they are decoded, start from an empty preview
+    active_img = transparent_img
     label_image_preview["image"] = active_img
+    image_loader.load_grid(target_concept, grid_cache, max_load_concept_images, __on_grid_loaded)
 
     active_img_tags, active_parent_tags = get_concept_tags(canonical_concept, concepts, current_dataset_tags)
 
@@ -254,6 +451,16 @@ def __set_active_concept(canonical_concept: str):
         __set_title(f"'{path}'")
 
 
+def __on_grid_loaded(concept: Concept, grid: Image, complete: bool):
+    global active_img
+
+    if concept is not active_concept:
+        return
+
+    active_img = ImageTk.PhotoImage(grid)
+    label_image_preview["image"] = active_img
+
+
 def __set_title(title: str | None = None):
     global active_title_fragment
     if not title:
@@ -264,43 +471,113 @@ def __set_title(title: str | None = None):
         root.title(f"{modified_star}fking captioner - {title}")
 
 
-def __load_concept_tree(src_dir: str) -> Concept:
-    global working_concept, working_directory
+def __load_concept_tree(src_dir: str):
+    """
+    Starts loading ``src_dir`` in the background, the tree fills in as directories are scanned and becomes editable
+    once the scan is complete.
+    """
+    global working_concept, working_directory, thumbnail_cache
 
+    dataset_loader.cancel()
+
+    working_concept = None
     working_directory = src_dir
+    __clear_tree()
 
-    if working_directory is not None and len(working_directory) > 0:
-        working_concept = create_concept("global", working_directory)
-        __build_tree(working_concept)
-    else:
-        working_concept = None
+    if working_directory is None or len(working_directory) <= 0:
+        return
+
+    thumbnail_cache = ThumbnailCache(working_directory, image_preview_size)
+    image_loader.thumbnail_cache = thumbnail_cache
+
+    label_load_status.config(text="Scanning...")
+    frame_load_status.pack(side=tk.BOTTOM, fill=tk.X, pady=(padding_half_size, 0), before=treeview_concept)
+    progress_load.start()
+
+    dataset_loader.load(working_directory, __on_concepts_loaded, __on_dataset_loaded)
+
+
+def __on_concepts_loaded(batch: list[Concept]):
+    new_children: dict[str, list[Concept]] = {}
+    for concept in batch:
+        __insert_concept(concept)
+        new_children.setdefault('' if concept.parent is None else concept.parent.canonical_name, []).append(concept)
+
+    # the order of a directory depends on all of its entries, so siblings are re-sorted once per batch they arrive in
+    for p_iid, added in new_children.items():
+        children = concept_row_children.get(p_iid, [])
+        sorted_children = concept_row_children[p_iid] = natural_sorted(
+                children + added,
+                lambda c: c.name,
+                strip_extension=False
+        )
+
+        # rows ahead of the first one out of place stay where they are, new rows were appended after any image rows
+        start = next((i for i, (a, b) in enumerate(zip(children, sorted_children)) if a is not b), len(children))
+        for position in range(start, len(sorted_children)):
+            treeview_concept.move(sorted_children[position].canonical_name, p_iid, position)
+
+    label_load_status.config(
+            text=f"Scanning... {dataset_loader.directories:,} directories, {dataset_loader.images:,} images"
+    )
+
+
+def __on_dataset_loaded(concept: Concept | None, index: TagIndex | None):
+    global working_concept, working_directory
+
+    progress_load.stop()
+    frame_load_status.pack_forget()
+
+    if concept is None:
+        working_directory = None
         __clear_tree()
+        __set_title()
+        return
 
-    return working_concept
+    working_concept = concept
+    __build_tree(concept, index)
 
 
-def __open_tree_item(iid: str):
-    treeview_concept.selection_clear()
-    treeview_concept.selection_set(iid)
-    treeview_concept.focus(iid)
+def on_cancel_load_button(event=None):
+    dataset_loader.cancel()
 
-    concept = sorted_concept_images[iid].concept if iid in sorted_concept_images else concepts[iid]
 
-    # event listener is firing this
-    # set_active_image(iid)
+def __open_tree_item(iid: str):
+    concept = concept_images[iid].concept if iid in concept_images else concepts[iid]
 
+    # image rows only exist once their concept was populated, which opening it programmatically does not trigger
     while concept is not None:
         concept_iid = concept.canonical_name
+        __populate_concept(concept_iid)
         treeview_concept.item(concept_iid, open=True)
         concept = concept.parent
 
+    treeview_concept.selection_clear()
+    treeview_concept.selection_set(iid)
+    treeview_concept.focus(iid)
+    treeview_concept.see(iid)
+
+    # event listener is firing this
+    # set_active_image(iid)
+
 
 def __clear_tree():
+    global tag_index, filtered_images
+
+    tag_index = None
+    filtered_images = None
+    tree_concept_images.clear()
+    populated_concepts.clear()
+    concept_row_children.clear()
+
     concepts.clear()
     concept_images.clear()
     current_dataset_tags.clear()
-    sorted_concept_images.clear()
+    dirty_items.clear()
+    navigation_index.clear()
+    image_loader.clear()
     image_cache.clear()
+    grid_cache.clear()
     last_modified_tags.clear()
 
     menu_file.entryconfig("Flatten Dataset", state=tk.DISABLED)
@@ -309,132 +586,92 @@ def __clear_tree():
     treeview_concept.delete(*treeview_concept.get_children())
 
 
-def __build_tree(concept: Concept):
-    __clear_tree()
+def __insert_concept(c: Concept):
+    """
+    Inserts the row of a concept as it is scanned, parents are always inserted before their children.
+    """
+    c_iid = c.canonical_name
+    concepts[c_iid] = c
 
-    def build(c: Concept, p: Concept = None):
-        concepts[c.canonical_name] = c
-
-        tree_inserts: dict[str, tuple] = {c.canonical_name: (
-            '' if p is None else p.canonical_name,
-            tk.END,
-            c.canonical_name,
-            c.name.replace('_', ' ').title()
-        )}
-
-        for ch in c.children:
-            children = build(ch, c)
-            tree_inserts.update(children[1])
-
-        for img in c.images:
-            i_cname = img.get_canonical_name()
-            concept_images[i_cname] = img
-
-            tree_inserts[i_cname] = (
-                c.canonical_name,
-                tk.END,
-                f"{c.canonical_name}.{img.get_filename()}",
-                img.get_filename()
-            )
-
-        return c.canonical_name, tree_inserts
-
-    def cmp_numeric(x, y):
-        if x == y:
-            return 0
-        elif x < y:
-            return -1
-        else:
-            return 1
-
-    # best just to keep this bad boy collapsed
-    def compare(a: str, b: str) -> int:
-        def is_numeric(x) -> (bool, float):
-            try:
-                f = float(x)
-                return True, f
-            except ValueError:
-                return False, None
-
-        def filename(x: str, is_img: bool) -> (str, str, str):
-            if is_img:
-                i_split = x.split(".")
-                i_len = len(i_split)
-
-                return f"{i_split[i_len - 2]}.{i_split[i_len - 1]}", i_split[i_len - 2], f".{i_split[i_len - 1]}"
-            else:
-                if "." in x:
-                    f = x[(x.rindex(".") + 1):]
-                    return f, f, ''
-                else:
-                    return x, x, ''
-
-        a_is_image = is_image(a)
-        b_is_image = is_image(b)
-
-        if not a_is_image and b_is_image:
-            return -1
-        elif a_is_image and not b_is_image:
-            return 1
-        elif b_is_image and not a_is_image:
-            return -1
-        else:
-            a_filename, a_name, a_ext = filename(a, a_is_image)
-            b_filename, b_name, b_ext = filename(b, b_is_image)
-
-            a_numeric, a_val = is_numeric(a_name)
-            b_numeric, b_val = is_numeric(b_name)
-
-            if a_numeric and b_numeric:
-                a_part = a[:a.rindex(a_filename) - 1]
-                b_part = b[:b.rindex(b_filename) - 1]
-
-                if a_part == b_part:
-                    return cmp_numeric(a_val, b_val)
-                elif a_part < b_part:
-                    return -1
-                else:
-                    return 1
-            elif a == b:
-                return 0
-            elif a < b:
-                return -1
-            else:
-                return 1
-
-    root_concept, tree_items = build(concept)
-    alphabetized_keys = list(set(tree_items.keys()))
-    alphabetized_keys.sort(key=cmp_to_key(compare))
-
-    print(f"Alphabetized: {', '.join(alphabetized_keys)}")
-
-    for a_key in alphabetized_keys:
-        parent, position, iid, text = tree_items[a_key]
-        if iid in concept_images:
-            sorted_concept_images[iid] = concept_images[iid]
-        treeview_concept.insert(parent, position, iid, text=text)
+    # moved into its sorted place once the rest of its batch is inserted
+    p_iid = '' if c.parent is None else c.parent.canonical_name
+    treeview_concept.insert(p_iid, tk.END, c_iid, text=c.name.replace('_', ' ').title(),
+                            tags=("modified",) if c_iid in dirty_items else ())
 
-    __open_tree_item(root_concept)
+    if len(c.images) <= 0:
+        return
+
+    # only concept rows are inserted up front, image rows follow when their concept is opened
+    image_iids = tree_concept_images[c_iid] = []
+    for img in natural_sorted(c.images, ConceptImage.get_filename):
+        i_cname = img.get_canonical_name()
+
+        concept_images[i_cname] = img
+        image_iids.append(i_cname)
+
+    treeview_concept.insert(c_iid, tk.END, __get_placeholder_iid(c_iid), text="...")
+
+
+def __build_tree(concept: Concept, index: TagIndex):
+    """
+    Completes the tree once every concept row was inserted.
+    """
+    global tag_index
+
+    # images are navigated in tree order, sub-concepts before own images
+    def build(c: Concept):
+        for ch in concept_row_children.get(c.canonical_name, ()):
+            build(ch)
+
+        for i_cname in tree_concept_images.get(c.canonical_name, ()):
+            navigation_index.append(i_cname, untagged=not concept_images[i_cname].has_sidecar)
+
+    build(concept)
+
+    tag_index = index
+    if len(entry_filter.get().strip()) > 0:
+        __apply_tree_filter()
+
+    __open_tree_item(concept.canonical_name)
 
     menu_file.entryconfig("Flatten Dataset", state=tk.NORMAL)
     menu_file.entryconfig("Save Dataset", state=tk.NORMAL)
 
 
 def __save_dataset():
-    tree_sel = treeview_concept.selection()
-    if tree_sel and len(tree_sel) > 0:
-        tree_sel = tree_sel[0]
+    global active_img_tags, active_parent_tags
 
-    touched = save_dataset(concepts, concept_images, current_dataset_tags)
+    tree_selection = treeview_concept.selection()
+    tree_sel = tree_selection[0] if len(tree_selection) > 0 else None
+    applied_tags = current_dataset_tags.get(tree_sel, [])[:]  # save_dataset may rewrite the pending list in place
+
+    # the saved images and concepts are updated in place, so the tree, the indexes and the image caches stay as they are
+    saved = save_dataset(concepts, concept_images, current_dataset_tags, list(dirty_items))
+
+    for iid in saved:
+        del current_dataset_tags[iid]
+        __set_dirty(iid, False)
+
+        if iid in concept_images:
+            navigation_index.set_untagged(iid, False)
+
+    # captions are saved with special tags expanded, the selection shows what was written unless it was edited since
+    # it was applied, otherwise the next apply would see the expanded tags as a change
+    if tree_sel in saved and __tags_from_text_field() == applied_tags:
+        if tree_sel in concept_images:
+            active_img_tags, active_parent_tags = get_image_tags(tree_sel, concepts, concept_images,
+                                                                 current_dataset_tags)
+        else:
+            active_img_tags, active_parent_tags = get_concept_tags(tree_sel, concepts, current_dataset_tags)
+
+        __set_tags_text(active_img_tags, active_parent_tags)
 
-    if touched <= 0:
+    __set_title(active_title_fragment)
+
+    if len(saved) <= 0:
         messagebox.showinfo("Save Complete", "Contents unchanged, no changes were written to disk.")
     else:
-        messagebox.showinfo("Save Complete", f"Modified {touched} file(s). Reloading changes from disk.")
-
-        active_iid = active_concept_image.get_canonical_name() if active_concept_image else tree_sel
-        __load_concept_tree(working_directory)
-        __open_tree_item(active_iid)
+        messagebox.showinfo("Save Complete", f"Modified {len(saved)} file(s).")
 
 
 def __tags_from_text_field():
@@ -473,6 +710,16 @@ menu_file.add_command(label="Save Dataset", command=on_menu_item_save, underline
 menu_file.add_separator()
 menu_file.add_command(label="Flatten Dataset", command=on_menu_item_flatten, underline=True, accelerator="Ctrl+L")
 
+flatten_link_mode = tk.StringVar(value=LinkMode.COPY.value)
+menu_flatten_mode = tk.Menu(menu_file)
+for link_mode in LinkMode:
+    menu_flatten_mode.add_radiobutton(label=link_mode.value.title(), value=link_mode.value, variable=flatten_link_mode)
+
+menu_file.add_cascade(label="Flatten Mode", menu=menu_flatten_mode)
+
+menu_file.add_separator()
+menu_file.add_command(label="Print Cache Statistics", command=on_menu_item_cache_stats)
+
 menu_file.entryconfig("Save Dataset", state=tk.DISABLED)
 menu_file.entryconfig("Flatten Dataset", state=tk.DISABLED)
 
@@ -484,15 +731,54 @@ root.bind_all("<Control-l>", on_menu_item_flatten)
 root.bind_all("<Control-o>", on_menu_item_open)
 root.bind_all("<Control-q>", on_request_exit)
 
+menu_navigate = tk.Menu(menubar)
+menubar.add_cascade(label="Navigate", menu=menu_navigate)
+
+menu_navigate.add_command(label="Previous Image", command=on_previous_button, accelerator="Alt+Left")
+menu_navigate.add_command(label="Next Image", command=on_next_button, accelerator="Alt+Right")
+
+menu_navigate.add_separator()
+menu_navigate.add_command(label="Next Untagged Image", command=on_next_untagged, accelerator="Alt+U")
+menu_navigate.add_command(label="Next Modified Image", command=on_next_modified, accelerator="Alt+M")
+
+root.bind_all("<Alt-Left>", on_previous_button)
+root.bind_all("<Alt-Right>", on_next_button)
+root.bind_all("<Alt-u>", on_next_untagged)
+root.bind_all("<Alt-m>", on_next_modified)
+
 root.protocol("WM_DELETE_WINDOW", on_request_exit)
 
-treeview_concept = ttk.Treeview(height=20, selectmode="browse", padding=(0, 0))
+frame_concept_tree = ttk.Frame(padding=(0, 0))
+frame_concept_tree.grid(row=0, column=0, sticky="news", padx=(padding_size, padding_half_size),
+                        pady=(padding_size, padding_half_size))
+
+entry_filter = tk.Entry(frame_concept_tree)
+entry_filter.pack(side=tk.TOP, fill=tk.X, pady=(0, padding_half_size))
+entry_filter.bind("<KeyRelease>", on_filter_changed)
+
+treeview_concept = ttk.Treeview(frame_concept_tree, height=20, selectmode="browse", padding=(0, 0))
 treeview_concept.heading("#0", text="Concept Tree", anchor=tk.W)
 
-treeview_concept.grid(row=0, column=0, sticky="news", padx=(padding_size, padding_half_size),
-                      pady=(padding_size, padding_half_size))
+treeview_concept.pack(side=tk.TOP, fill=tk.BOTH, expand=True)
+
+# shown below the tree while a dataset is loading
+frame_load_status = ttk.Frame(frame_concept_tree, padding=(0, 0))
+
+label_load_status = ttk.Label(frame_load_status, anchor=tk.W)
+label_load_status.pack(side=tk.TOP, fill=tk.X)
+
+progress_load = ttk.Progressbar(frame_load_status, mode="indeterminate")
+progress_load.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(0, padding_half_size))
+
+button_cancel_load = tk.Button(frame_load_status, text="Cancel")
+button_cancel_load.pack(side=tk.RIGHT)
+
+button_cancel_load.bind("<Button-1>", on_cancel_load_button)
+
+treeview_concept.tag_configure("modified", foreground="blue")
 
 treeview_concept.bind('<<TreeviewSelect>>', on_tree_view_child_click)
+treeview_concept.bind('<<TreeviewOpen>>', on_tree_view_open)
 
 root.grid_rowconfigure(0, minsize=image_preview_size, weight=1)
 root.grid_rowconfigure(1, minsize=32)
@@ -533,13 +819,28 @@ button_save.grid(row=5, column=2, sticky="news", padx=(padding_half_size, paddin
 
 button_save.bind("<Button-1>", on_apply_button)
 
-button_next = tk.Button(text="Next")
-button_next.grid(row=6, column=2, sticky="news", padx=(padding_half_size, padding_half_size), pady=(0, padding_size))
+frame_navigation = ttk.Frame(padding=(0, 0))
+frame_navigation.grid(row=6, column=2, sticky="news", padx=(padding_half_size, padding_half_size),
+                      pady=(0, padding_size))
+
+button_previous = tk.Button(frame_navigation, text="Prev")
+button_previous.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+
+button_previous.bind("<Button-1>", on_previous_button)
+
+button_next = tk.Button(frame_navigation, text="Next")
+button_next.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
 
 button_next.bind("<Button-1>", on_next_button)
 
 
-def show_ui():
+def show_ui(preview_cache_mb: int | None = None, grid_cache_mb: int | None = None):
+    if preview_cache_mb is not None:
+        image_cache.max_bytes = preview_cache_mb * 2 ** 20
+
+    if grid_cache_mb is not None:
+        grid_cache.max_bytes = grid_cache_mb * 2 ** 20
+
     root.focus_force()
     root.config(menu=menubar)
     root.mainloop()
@@ -0,0 +1,320 @@
+import contextlib
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+cache_directory_name = ".fking_cache"
+sync_manifest_name = ".fking_sync.json"
+
+
+def get_cache_directory(dataset_root: str, create: bool = True) -> str:
+    cache_directory = os.path.join(dataset_root, cache_directory_name)
+    if create:
+        os.makedirs(cache_directory, exist_ok=True)
+
+    return cache_directory
+
+
+def get_dataset_key(dataset_root: str, path: str) -> str:
+    """
+    :return: ``path`` relative to ``dataset_root``, the key the dataset caches store it under so they survive the
+    dataset being moved
+    """
+    return path[len(dataset_root):].lstrip("/\\")
+
+
+@contextlib.contextmanager
+def atomic_replace(path: str):
+    """
+    Yields a temporary path next to ``path`` that is renamed over it once the block completes, so readers only ever
+    see the old or the new file. The temporary file, if the block created one, is removed when the block fails.
+    """
+    directory, name = os.path.split(path)
+    tmp_path = os.path.join(directory, f".{name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+
+
+def caption_digest(caption: str) -> str:
+    return hashlib.blake2b(caption.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def read_sync_manifest(path: str) -> tuple[dict[str, str], dict[str, str]]:
+    """
+    :return: the images (output name to source path) and captions (output name to content digest) of the last sync
+    """
+    try:
+        with open(path) as f:
+            sync_manifest = json.load(f)
+            f.close()
+    except FileNotFoundError:
+        return {}, {}
+    except ValueError:
+        print(f"\nWARNING: Sync manifest '{path}' is unreadable, treating every output as new.\n")
+        return {}, {}
+
+    return sync_manifest.get("images", {}), sync_manifest.get("captions", {})
+
+
+def write_sync_manifest(path: str, images: dict[str, str], captions: dict[str, str]):
+    sync_manifest = {
+        "images": images,
+        "captions": {caption_name: caption_digest(caption) for caption_name, caption in captions.items()}
+    }
+
+    with atomic_replace(path) as tmp_path:
+        with open(tmp_path, "w") as f:
+            json.dump(sync_manifest, f)
+            f.close()
+
+
+class ScanManifest:
+    """
+    On-disk record of a dataset scan, stored in ``<dataset>/.fking_cache/manifest.sqlite3``.
+
+    Directories are stored with their mtime and listing, text files (prompts, special tags and image sidecars) with
+    their mtime, size and parsed contents. Paths are keyed relative to the dataset root, so the manifest survives the
+    dataset being moved.
+
+    The manifest is read into memory when opened and only written back by ``save``, so lookups and updates are safe
+    from the scanner's worker threads.
+    """
+
+    __version = 1
+
+    def __init__(self, dataset_root: str):
+        self.dataset_root = dataset_root
+        self.path = os.path.join(get_cache_directory(dataset_root, create=False), "manifest.sqlite3")
+
+        self.__lock = threading.Lock()
+
+        self.__directories: dict[str, tuple[int, list]] = {}
+        self.__files: dict[str, tuple[int, int, object]] = {}
+
+        self.__updated_directories: dict[str, tuple[int, list]] = {}
+        self.__updated_files: dict[str, tuple[int, int, object]] = {}
+
+        self.__seen_directories: set[str] = set()
+        self.__seen_files: set[str] = set()
+
+        self.__load()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.save()
+
+    def __connect(self) -> sqlite3.Connection:
+        get_cache_directory(self.dataset_root)
+        connection = sqlite3.connect(self.path, timeout=30)
+
+        if connection.execute("PRAGMA user_version").fetchone()[0] != ScanManifest.__version:
+            connection.execute("DROP TABLE IF EXISTS directories")
+            connection.execute("DROP TABLE IF EXISTS files")
+            connection.execute(f"PRAGMA user_version = {ScanManifest.__version}")
+
+        connection.execute("CREATE TABLE IF NOT EXISTS directories "
+                           "(path TEXT PRIMARY KEY, mtime_ns INTEGER, listing TEXT)")
+        connection.execute("CREATE TABLE IF NOT EXISTS files "
+                           "(path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, content TEXT)")
+
+        return connection
+
+    def __load(self):
+        try:
+            connection = self.__connect()
+        except (OSError, sqlite3.Error) as e:
+            print(f"\nWARNING: Unable to open scan manifest '{self.path}', rescanning everything. ({e})\n")
+            return
+
+        with connection:
+            for path, mtime_ns, listing in connection.execute("SELECT path, mtime_ns, listing FROM directories"):
+                self.__directories[path] = mtime_ns, json.loads(listing)
+
+            for path, mtime_ns, size, content in connection.execute("SELECT path, mtime_ns, size, content FROM files"):
+                self.__files[path] = mtime_ns, size, json.loads(content)
+
+        connection.close()
+
+    def get_directory(self, path: str, mtime_ns: int) -> list | None:
+        key = get_dataset_key(self.dataset_root, path)
+        self.__seen_directories.add(key)
+
+        cached = self.__directories.get(key)
+        if cached is None or cached[0] != mtime_ns:
+            return None
+
+        return cached[1]
+
+    def put_directory(self, path: str, mtime_ns: int, listing: list):
+        key = get_dataset_key(self.dataset_root, path)
+
+        with self.__lock:
+            self.__seen_directories.add(key)
+            self.__directories[key] = self.__updated_directories[key] = mtime_ns, listing
+
+    def get_file(self, path: str, mtime_ns: int, size: int) -> object | None:
+        key = get_dataset_key(self.dataset_root, path)
+        self.__seen_files.add(key)
+
+        cached = self.__files.get(key)
+        if cached is None or cached[0] != mtime_ns or cached[1] != size:
+            return None
+
+        return cached[2]
+
+    def put_file(self, path: str, mtime_ns: int, size: int, content: object):
+        key = get_dataset_key(self.dataset_root, path)
+
+        with self.__lock:
+            self.__seen_files.add(key)
+            self.__files[key] = self.__updated_files[key] = mtime_ns, size, content
+
+    def save(self, prune: bool = True):
+        """
+        Writes changed entries back to disk and drops entries that were not visited since the manifest was opened.
+
+        :param prune: False keeps the unvisited entries, for scans that stopped early and did not visit everything
+        """
+        with self.__lock:
+            stale_directories = [(k,) for k in self.__directories.keys() - self.__seen_directories] if prune else []
+            stale_files = [(k,) for k in self.__files.keys() - self.__seen_files] if prune else []
+
+            updated_directories = [
+                (k, mtime_ns, json.dumps(listing))
+                for k, (mtime_ns, listing) in self.__updated_directories.items()
+            ]
+            updated_files = [
+                (k, mtime_ns, size, json.dumps(content))
+                for k, (mtime_ns, size, content) in self.__updated_files.items()
+            ]
+
+            for k, in stale_directories:
+                del self.__directories[k]
+
+            for k, in stale_files:
+                del self.__files[k]
+
+            self.__updated_directories.clear()
+            self.__updated_files.clear()
+
+        if len(stale_directories) + len(stale_files) + len(updated_directories) + len(updated_files) <= 0:
+            return
+
+        try:
+            connection = self.__connect()
+            with connection:
+                connection.executemany("DELETE FROM directories WHERE path = ?", stale_directories)
+                connection.executemany("DELETE FROM files WHERE path = ?", stale_files)
+                connection.executemany("INSERT OR REPLACE INTO directories VALUES (?, ?, ?)", updated_directories)
+                connection.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", updated_files)
+
+            connection.close()
+        except (OSError, sqlite3.Error) as e:
+            print(f"\nWARNING: Unable to save scan manifest '{self.path}'. ({e})\n")
+
+
+class HashCache:
+    """
+    Persistent content hashes of dataset files, stored in ``<dataset>/.fking_cache/hashes.sqlite3``.
+
+    Entries are keyed by path relative to the dataset root together with size, mtime and inode, a file whose metadata
+    changed in any way is hashed again. With ``verify`` set every lookup misses, so every file is re-hashed and any
+    cached hash that turns out to be wrong is reported and replaced.
+
+    Only new or changed entries are written back by ``save``, each in its own row, so several processes can share one
+    cache without overwriting each other's work.
+    """
+
+    def __init__(self, dataset_root: str, verify: bool = False):
+        self.dataset_root = dataset_root
+        self.path = os.path.join(get_cache_directory(dataset_root, create=False), "hashes.sqlite3")
+        self.verify = verify
+
+        self.mismatches = 0
+
+        self.__lock = threading.Lock()
+
+        self.__hashes: dict[str, tuple[int, int, int, str]] = {}
+        self.__updated_hashes: dict[str, tuple[int, int, int, str]] = {}
+
+        self.__load()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.save()
+
+    def __connect(self) -> sqlite3.Connection:
+        get_cache_directory(self.dataset_root)
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS hashes "
+                           "(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, hash TEXT)")
+
+        return connection
+
+    def __load(self):
+        try:
+            connection = self.__connect()
+        except (OSError, sqlite3.Error) as e:
+            print(f"\nWARNING: Unable to open hash cache '{self.path}', hashing everything. ({e})\n")
+            return
+
+        with connection:
+            for path, size, mtime_ns, inode, file_hash in connection.execute("SELECT * FROM hashes"):
+                self.__hashes[path] = size, mtime_ns, inode, file_hash
+
+        connection.close()
+
+    def get(self, path: str, stat: os.stat_result) -> str | None:
+        if self.verify:
+            return None
+
+        cached = self.__hashes.get(get_dataset_key(self.dataset_root, path))
+        if cached is None or cached[:3] != (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+            return None
+
+        return cached[3]
+
+    def put(self, path: str, stat: os.stat_result, file_hash: str):
+        key = get_dataset_key(self.dataset_root, path)
+        entry = stat.st_size, stat.st_mtime_ns, stat.st_ino, file_hash
+
+        with self.__lock:
+            cached = self.__hashes.get(key)
+            if cached == entry:
+                return
+
+            if self.verify and cached is not None and cached[:3] == entry[:3]:
+                self.mismatches += 1
+                print(f"\nWARNING: Cached hash of '{path}' did not match its contents, replacing it.\n")
+
+            self.__hashes[key] = self.__updated_hashes[key] = entry
+
+    def save(self):
+        with self.__lock:
+            updated_hashes = [(k, *entry) for k, entry in self.__updated_hashes.items()]
+            self.__updated_hashes.clear()
+
+        if len(updated_hashes) <= 0:
+            return
+
+        try:
+            connection = self.__connect()
+            with connection:
+                connection.executemany("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)", updated_hashes)
+
+            connection.close()
+        except (OSError, sqlite3.Error) as e:
+            print(f"\nWARNING: Unable to save hash cache '{self.path}'. ({e})\n")
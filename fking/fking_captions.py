@@ -1,61 +1,163 @@
+import csv
 import os
-import shutil
 import textwrap
+import threading
+from array import array
+from collections import deque
+from collections.abc import Callable, Iterator
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 
-from fking.fking_utils import find_and_replace_special_tags, is_image, merge_special_tags, normalize_tags, \
-    read_special_tags_from_file, read_tags_from_file, sha256_file_hash, write_tags
+from fking.fking_cache import HashCache, ScanManifest, cache_directory_name, caption_digest, read_sync_manifest, \
+    sync_manifest_name, write_sync_manifest
+from fking.fking_utils import LinkMode, SpecialTagMergeMode, compile_special_tags, expand_special_tags, is_image, \
+    link_file, merge_special_tags, normalize_tags, parse_special_tags, read_special_tags_data, \
+    read_special_tags_from_file, read_tags_from_file, sha256_file_hash, tag_vocabulary, write_tags
 
 
 class FkingImage:
+    # images are the bulk of a loaded dataset, so they are kept compact: no instance __dict__, the path is stored
+    # relative to the owning concept's working directory where possible and tags are ids into the tag vocabulary
+    __slots__ = ("concept", "_path", "_relative", "_tag_ids")
+
     def __init__(self, concept, path: str, tags: list[str]):
         self.concept: Concept = concept
         self.path = path
         self.tags = tags
 
+    @property
+    def path(self) -> str:
+        if self._relative:
+            return os.path.join(self.concept.working_directory, self._path)
+
+        return self._path
+
+    @path.setter
+    def path(self, path: str):
+        filename = os.path.basename(path)
+
+        self._relative = os.path.join(self.concept.working_directory, filename) == path
+        self._path = filename if self._relative else path
+
+    @property
+    def tags(self) -> list[str]:
+        return tag_vocabulary.get_tags(self._tag_ids)
+
+    @tags.setter
+    def tags(self, tags: list[str]):
+        self._tag_ids = tag_vocabulary.intern_all(tags)
+
+    @property
+    def tag_ids(self) -> array:
+        return self._tag_ids
+
     def get_filename(self, part: 0 | 1 | -1 = -1) -> str:
+        filename = self._path if self._relative else os.path.basename(self._path)
+
         if part == -1:
-            return os.path.basename(self.path)
+            return filename
         else:
-            return os.path.splitext(os.path.basename(self.path))[part]
+            return os.path.splitext(filename)[part]
 
     def get_canonical_name(self) -> str:
         return f"{self.concept.canonical_name}.{self.get_filename()}"
 
 
 class CaptionedImage(FkingImage):
+    __slots__ = ()
+
     def __init__(self, concept, path: str, tags: list[str]):
         super().__init__(concept, path, tags)
 
 
 class ConceptImage(FkingImage):
-    def __init__(self, concept, path, tags: list[str] = None) -> None:
-        super().__init__(concept, path, [] if tags is None else tags)
+    __slots__ = ("has_sidecar",)
 
-    def generate_tags(self):
-        c_tags = self.tags[:]
+    def __init__(self, concept, path, tags: list[str] = None, has_sidecar: bool | None = None) -> None:
+        tags = [] if tags is None else tags
+        super().__init__(concept, path, tags)
 
-        parent: Concept = self.concept
-        while parent is not None:
-            p_tags = parent.concept_tags[:]
-            p_tags.reverse()
+        # whether a caption file exists next to the image, assumed from its tags when the scanner did not say
+        self.has_sidecar = len(tags) > 0 if has_sidecar is None else has_sidecar
 
-            c_tags.extend(p_tags)
-            parent = parent.parent
+    def generate_tags(self):
+        prefix, prefix_set = self.concept.get_resolved_tags()
+        # own tags end up after the inherited prefix in reverse order, kept as-is for output compatibility
+        own_tags = _dedup_last([t.strip() for t in reversed(self.tags)])
+
+        if len(own_tags) <= 0:
+            return prefix[:]
 
-        u_tags = []
-        for t in c_tags:
-            t = t.strip()
-            if t not in u_tags:
-                u_tags.append(t)
+        # an own tag that is also inherited moves to its own position, same as a plain keep-last de-duplication
+        if any(t in prefix_set for t in own_tags):
+            own_set = set(own_tags)
+            return [t for t in prefix if t not in own_set] + own_tags
 
-        u_tags.reverse()
-        return u_tags
+        return prefix + own_tags
 
     def build(self) -> tuple[str, list[str]]:
         tags = self.generate_tags()
         return self.path, normalize_tags(tags)
 
 
+class CaptionStatistics:
+    """
+    Prompt and tag statistics gathered while captions are written, so the output does not have to be read back.
+
+    Unique prompts and tags are kept in first-seen order. Tag counts are per flattened image, together with the
+    number of distinct concepts whose images carry the tag.
+    """
+
+    def __init__(self):
+        self.unique_prompts: dict[str, None] = {}
+        self.unique_tags: dict[str, None] = {}
+
+        self.tag_counts: dict[str, int] = {}
+        self.tag_concepts: dict[str, set[str]] = {}
+
+    def add_image(self, concept, tags: list[str]):
+        concept_name = concept.canonical_name
+
+        for t in tags:
+            self.tag_counts[t] = self.tag_counts.get(t, 0) + 1
+
+            tag_concepts = self.tag_concepts.get(t)
+            if tag_concepts is None:
+                tag_concepts = self.tag_concepts[t] = set()
+
+            tag_concepts.add(concept_name)
+
+    def add_caption(self, tags: list[str]):
+        self.unique_prompts[", ".join(tags)] = None
+
+        for t in tags:
+            self.unique_tags[t] = None
+
+    def get_tag_frequencies(self) -> list[tuple[str, int, int]]:
+        """
+        :return: tag, image count and concept count of every tag, most frequent first
+        """
+        frequencies = [(t, count, len(self.tag_concepts[t])) for t, count in self.tag_counts.items()]
+        frequencies.sort(key=lambda f: (-f[1], -f[2], f[0]))
+
+        return frequencies
+
+    def write(self, dst: str):
+        unique_prompts_file_path = os.path.join(dst, "unique_prompt.txt")
+        with open(unique_prompts_file_path, "w+") as f:
+            f.writelines(up + "\n" for up in self.unique_prompts)
+            f.close()
+
+        unique_tags_file_path = os.path.join(dst, "unique_tags.txt")
+        write_tags(unique_tags_file_path, list(self.unique_tags))
+
+        tag_frequencies_file_path = os.path.join(dst, "tag_frequencies.csv")
+        with open(tag_frequencies_file_path, "w+", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(("tag", "count", "concepts"))
+            writer.writerows(self.get_tag_frequencies())
+            f.close()
+
+
 class Concept:
     """
     :type name: str
@@ -64,14 +166,26 @@ class Concept:
     :type parent: Concept|None
     """
 
-    def __init__(self, name: str, working_directory: str, parent=None) -> None:
+    __slots__ = (
+        "name", "parent", "working_directory", "raw_tags", "concept_tags", "special_tags", "children", "images",
+        "canonical_name", "_resolved_tags", "_expanded_tags", "_special_expansions"
+    )
+
+    def __init__(
+            self,
+            name: str,
+            working_directory: str,
+            parent=None,
+            raw_tags: list[str] = None,
+            special_tags: dict[str, tuple[SpecialTagMergeMode, list[str]]] = None
+    ) -> None:
         self.name = name
         self.parent = parent
         self.working_directory = working_directory
 
         tags_file_path = os.path.join(working_directory, "__prompt.txt")
 
-        self.raw_tags = read_tags_from_file(tags_file_path)
+        self.raw_tags = read_tags_from_file(tags_file_path) if raw_tags is None else raw_tags
         self.concept_tags = self.raw_tags[:]
 
         self.concept_tags = [
@@ -84,18 +198,24 @@ class Concept:
                 print(f"\nWARNING: You have an incomplete special tag '{t}' in prompt file '{tags_file_path}'.\n")
 
         special_tags_file_path = os.path.join(working_directory, "__special.txt")
-        self.special_tags = read_special_tags_from_file(special_tags_file_path)
+        self.special_tags = read_special_tags_from_file(special_tags_file_path) \
+            if special_tags is None else special_tags
 
         self.children: list[Concept] = []
         self.images: list[ConceptImage] = []
 
+        self._resolved_tags: tuple[list[str], set[str]] | None = None
+        self._expanded_tags: tuple[list[str], set[str]] | None = None
+        self._special_expansions: dict[str, tuple[str, ...]] | None = None
+
+        # the parent's special tags already include those of its own ancestors
+        if parent is not None:
+            self.special_tags = merge_special_tags(parent.special_tags, self.special_tags)
+
         self.canonical_name = name
 
         __parent = parent
         while __parent is not None:
-            __parent_special_tags = parent.special_tags if parent is not None else {}
-            self.special_tags = merge_special_tags(__parent_special_tags, self.special_tags)
-
             self.canonical_name = f"{__parent.name}.{self.canonical_name}"
             __parent = __parent.parent
 
@@ -105,88 +225,529 @@ class Concept:
     def add_image(self, image: ConceptImage):
         self.images.append(image)
 
-    def flatten(self) -> list[CaptionedImage]:
-        captioned_images = []
-
-        for child in self.children:
-            captioned_images.extend(child.flatten())
+    def get_resolved_tags(self) -> tuple[list[str], set[str]]:
+        """
+        The tag prefix every image of this concept inherits, the concept tags of each ancestor from the root down,
+        keeping the last occurrence of a repeated tag. Resolved once from the parent's prefix and cached.
+        """
+        if self._resolved_tags is None:
+            parent_tags = self.parent.get_resolved_tags()[0] if self.parent is not None else []
+
+            own_tags = _dedup_last([t.strip() for t in self.concept_tags])
+            own_set = set(own_tags)
+
+            resolved = [t for t in parent_tags if t not in own_set] + own_tags
+            self._resolved_tags = resolved, set(resolved)
+
+        return self._resolved_tags
+
+    def get_expanded_tags(self) -> tuple[list[str], set[str]]:
+        """
+        The resolved tag prefix with this concept's special tags replaced, cached.
+        """
+        if self._expanded_tags is None:
+            expanded = expand_special_tags(self.get_resolved_tags()[0], self.get_special_expansions())
+            self._expanded_tags = expanded, set(expanded)
+
+        return self._expanded_tags
+
+    def get_special_expansions(self) -> dict[str, tuple[str, ...]]:
+        """
+        This concept's special tags compiled into a flat expansion map, cached. Concepts without special tags of their
+        own share the table, and the compiled map, of their parent.
+        """
+        if self._special_expansions is None:
+            if self.parent is not None and self.parent.special_tags is self.special_tags:
+                self._special_expansions = self.parent.get_special_expansions()
+            else:
+                self._special_expansions = compile_special_tags(self.special_tags)
 
-        special_tags = self.special_tags
+        return self._special_expansions
 
-        for img in self.images:
-            path, tags = img.build()
-            tags = find_and_replace_special_tags(tags, special_tags)
+    def set_raw_tags(self, raw_tags: list[str]):
+        """
+        Replaces the tags of this concept's ``__prompt.txt``, e.g. after it was edited, and drops the cached prefixes.
+        """
+        self.raw_tags = raw_tags
+        self.concept_tags = [
+            t if '__folder__' not in t else t.replace('__folder__', self.name.replace('_', ' '))
+            for t in raw_tags
+        ]
 
-            captioned_img = CaptionedImage(self, path, tags)
-            captioned_images.append(captioned_img)
+        self.invalidate_resolved_tags()
+
+    def invalidate_resolved_tags(self):
+        """
+        Drops the cached prefixes of this concept and all of its descendants, call after changing concept or special
+        tags.
+        """
+        stack = [self]
+        while len(stack) > 0:
+            concept = stack.pop()
+            concept._resolved_tags = None
+            concept._expanded_tags = None
+            concept._special_expansions = None
+            stack.extend(concept.children)
+
+    def build_image_tags(self, img: ConceptImage) -> list[str]:
+        """
+        The final caption of one of this concept's images, same as ``find_and_replace_special_tags(img.build()[1])``
+        but costing only a lookup per own tag of the image on top of copying the cached prefix.
+        """
+        prefix, prefix_set = self.get_resolved_tags()
+        own_tags = _dedup_last([t.strip() for t in reversed(img.tags) if len(t.strip()) > 0])
+
+        if any(t in prefix_set for t in own_tags):
+            return expand_special_tags(img.build()[1], self.get_special_expansions())
+
+        expanded, expanded_set = self.get_expanded_tags()
+        expansions = self.get_special_expansions()
+
+        tags = expanded[:]
+        added: set[str] = set()
+
+        for t in own_tags:
+            for r in expansions.get(t, (t,)):
+                if r not in expanded_set and r not in added:
+                    added.add(r)
+                    tags.append(r)
+
+        return tags
 
-        return captioned_images
+    def flatten(self) -> list[CaptionedImage]:
+        return list(self.iter_flatten())
+
+    def iter_flatten(self) -> Iterator[CaptionedImage]:
+        # depth-first with an explicit stack, children before a concept's own images, so deep trees neither recurse
+        # nor pay a generator hop per level for every image
+        stack = [(self, iter(self.children))]
+
+        while len(stack) > 0:
+            concept, children = stack[-1]
+
+            child = next(children, None)
+            if child is not None:
+                stack.append((child, iter(child.children)))
+                continue
+
+            stack.pop()
+
+            for img in concept.images:
+                yield CaptionedImage(concept, img.path, concept.build_image_tags(img))
+
+    def write(
+            self,
+            dst: str,
+            max_workers: int | None = None,
+            use_processes: bool = False,
+            hash_cache: HashCache | None = None,
+            link_mode: LinkMode = LinkMode.COPY,
+            stats: CaptionStatistics | None = None
+    ) -> list[CaptionedImage]:
+        return list(self.iter_write(dst, max_workers, use_processes, hash_cache, link_mode, stats))
+
+    def iter_write(
+            self,
+            dst: str,
+            max_workers: int | None = None,
+            use_processes: bool = False,
+            hash_cache: HashCache | None = None,
+            link_mode: LinkMode = LinkMode.COPY,
+            stats: CaptionStatistics | None = None
+    ) -> Iterator[CaptionedImage]:
+        """
+        Writes the flattened concept to ``dst``, yielding each image in flatten order as it is placed.
+
+        Images are hashed ahead of the writer on a pool of ``max_workers`` threads, or processes when
+        ``use_processes`` is set, and copied on a thread pool. Captions of images with the same content are merged in
+        memory, newest first and on top of any caption already in ``dst``, and each caption file is written exactly
+        once, atomically, after the last image was placed.
+
+        With a ``hash_cache`` only images whose size, mtime or inode changed since they were last hashed are read.
+        Images are placed with ``link_mode``, falling back to a copy where that mode is not possible. Prompt and tag
+        statistics of the written captions are gathered into ``stats`` when given.
+        """
+        os.makedirs(dst, exist_ok=True)
 
-    def write(self, dst: str) -> list[CaptionedImage]:
-        images = self.flatten()
-        output: list[CaptionedImage] = []
+        links = _LinkQueue(dst, link_mode, _pending_window(max_workers))
 
+        # merged captions by output caption path, as tag ids to keep large datasets compact
+        captions: dict[str, array] = {}
+        # output images placed, or being placed, by this write; same content with another extension is its own output
+        placed: set[str] = set()
+
+        with ThreadPoolExecutor(max_workers) as io_executor:
+            for img, img_hash in self.iter_hashed(max_workers, use_processes, hash_cache):
+                img_path = img.path
+                img_extension = os.path.splitext(img_path)[1]
+
+                img_dst_file_path = f"{img_hash}{img_extension}"
+                img_dst_file_path = os.path.join(dst, img_dst_file_path)
+
+                img_tags_txt_file_path = f"{img_hash}.txt"
+                img_tags_txt_file_path = os.path.join(dst, img_tags_txt_file_path)
+
+                if img_dst_file_path not in placed:
+                    placed.add(img_dst_file_path)
+                    if not os.path.exists(img_dst_file_path):
+                        links.append(io_executor.submit(link_file, img_path, img_dst_file_path, link_mode))
+
+                existing_tag_ids = captions.get(img_tags_txt_file_path)
+                if existing_tag_ids is None:
+                    existing_tags = read_tags_from_file(img_tags_txt_file_path) \
+                        if os.path.exists(img_tags_txt_file_path) else []
+                else:
+                    existing_tags = tag_vocabulary.get_tags(existing_tag_ids)
+
+                img_tags = img.tags
+                if stats is not None:
+                    stats.add_image(img.concept, img_tags)
+
+                out_tags = normalize_tags(img_tags + existing_tags)
+                captions[img_tags_txt_file_path] = tag_vocabulary.intern_all(out_tags)
+
+                yield CaptionedImage(self, img_dst_file_path, out_tags)
+
+            for img_tags_txt_file_path, tag_ids in captions.items():
+                out_tags = tag_vocabulary.get_tags(tag_ids)
+                if stats is not None:
+                    stats.add_caption(out_tags)
+
+                links.append(io_executor.submit(write_tags, img_tags_txt_file_path, out_tags, atomic=True))
+
+            links.wait()
+
+    def iter_hashed(
+            self,
+            max_workers: int | None = None,
+            use_processes: bool = False,
+            hash_cache: HashCache | None = None
+    ) -> Iterator[tuple[CaptionedImage, str]]:
+        """
+        Yields each flattened image with the sha256 of its source file, in flatten order, hashing ahead on a pool of
+        ``max_workers`` threads or processes and consulting ``hash_cache`` first when given.
+        """
+        window = _pending_window(max_workers)
+        hash_executor = ProcessPoolExecutor(max_workers) if use_processes else ThreadPoolExecutor(max_workers)
+
+        pending: deque[tuple[CaptionedImage, Future, os.stat_result | None]] = deque()
+
+        def hashed_next() -> tuple[CaptionedImage, str]:
+            img, img_hash_future, img_stat = pending.popleft()
+
+            img_hash = img_hash_future.result()
+            if img_stat is not None:
+                hash_cache.put(img.path, img_stat, img_hash)
+
+            return img, img_hash
+
+        with hash_executor:
+            for captioned_img in self.iter_flatten():
+                captioned_img_path = captioned_img.path
+
+                captioned_img_stat = None
+                captioned_img_hash = None
+
+                if hash_cache is not None:
+                    captioned_img_stat = os.stat(captioned_img_path)
+                    captioned_img_hash = hash_cache.get(captioned_img_path, captioned_img_stat)
+
+                if captioned_img_hash is not None:
+                    captioned_img_hash_future = Future()
+                    captioned_img_hash_future.set_result(captioned_img_hash)
+                else:
+                    captioned_img_hash_future = hash_executor.submit(sha256_file_hash, captioned_img_path)
+
+                pending.append((captioned_img, captioned_img_hash_future, captioned_img_stat))
+
+                if len(pending) >= window:
+                    yield hashed_next()
+
+            while len(pending) > 0:
+                yield hashed_next()
+
+    def sync(
+            self,
+            dst: str,
+            max_workers: int | None = None,
+            use_processes: bool = False,
+            hash_cache: HashCache | None = None,
+            link_mode: LinkMode = LinkMode.COPY,
+            stats: CaptionStatistics | None = None
+    ) -> tuple[int, int, int, int]:
+        """
+        Brings ``dst`` up to date with the flattened concept, diffing against the manifest of the previous sync stored
+        in ``dst``. Only new images are placed, only captions whose content changed are rewritten and outputs of
+        images that no longer exist are deleted. Unlike ``write``, captions are never merged with whatever is already
+        on disk, ``dst`` is treated as owned by the sync.
+
+        Prompt and tag statistics of the synced captions are gathered into ``stats`` when given.
+
+        :return: images placed, captions written, outputs deleted, images flattened
+        """
         os.makedirs(dst, exist_ok=True)
 
-        for img in images:
+        sync_manifest_path = os.path.join(dst, sync_manifest_name)
+        previous_images, previous_captions = read_sync_manifest(sync_manifest_path)
+
+        planned_images: dict[str, str] = {}
+        planned_captions: dict[str, list[str]] = {}
+        flattened = 0
+
+        for img, img_hash in self.iter_hashed(max_workers, use_processes, hash_cache):
+            flattened += 1
             img_path = img.path
 
-            img_hash = sha256_file_hash(img_path)
-            img_extension = os.path.splitext(img_path)[1]
+            planned_images.setdefault(f"{img_hash}{os.path.splitext(img_path)[1]}", img_path)
 
-            img_dst_file_path = f"{img_hash}{img_extension}"
-            img_dst_file_path = os.path.join(dst, img_dst_file_path)
+            img_tags = img.tags
+            if stats is not None:
+                stats.add_image(img.concept, img_tags)
 
-            img_tags_txt_file_path = f"{img_hash}.txt"
-            img_tags_txt_file_path = os.path.join(dst, img_tags_txt_file_path)
+            caption = planned_captions.setdefault(f"{img_hash}.txt", [])
+            caption[0:0] = img_tags
 
-            if not os.path.exists(img_dst_file_path):
-                shutil.copyfile(img_path, img_dst_file_path)
+        captions: dict[str, str] = {}
+        for caption_name, caption_tags in planned_captions.items():
+            caption_tags = normalize_tags(caption_tags)
+            if stats is not None:
+                stats.add_caption(caption_tags)
 
-            out_tags = img.tags[:]
-            if not os.path.exists(img_tags_txt_file_path):
-                write_tags(img_tags_txt_file_path, out_tags)
-            else:
-                existing_tags = read_tags_from_file(img_tags_txt_file_path)
-                out_tags.extend(existing_tags)
+            captions[caption_name] = ", ".join(caption_tags)
+
+        del planned_captions
+
+        placed = 0
+        written = 0
+        deleted = 0
+
+        links = _LinkQueue(dst, link_mode, _pending_window(max_workers))
+
+        with ThreadPoolExecutor(max_workers) as io_executor:
+            for img_name, img_path in planned_images.items():
+                img_dst_file_path = os.path.join(dst, img_name)
+
+                # exists follows symlinks, so links whose source is gone are placed again; a symlink is also replaced
+                # when its source moved, the old path may since hold a different image
+                if img_name not in previous_images or not os.path.exists(img_dst_file_path) \
+                        or (link_mode is LinkMode.SYMLINK and previous_images[img_name] != img_path):
+                    placed += 1
+                    links.append(io_executor.submit(link_file, img_path, img_dst_file_path, link_mode))
 
-                write_tags(img_tags_txt_file_path, out_tags)
+            for caption_name, caption in captions.items():
+                caption_file_path = os.path.join(dst, caption_name)
+                if previous_captions.get(caption_name) != caption_digest(caption) \
+                        or not os.path.exists(caption_file_path):
+                    written += 1
+                    links.append(io_executor.submit(write_tags, caption_file_path, caption.split(", "), atomic=True))
 
-            out = CaptionedImage(self, img_dst_file_path, out_tags)
-            output.append(out)
+            stale_outputs = [n for n in previous_images if n not in planned_images] \
+                            + [n for n in previous_captions if n not in captions]
 
-        return output
+            for stale_name in stale_outputs:
+                stale_file_path = os.path.join(dst, stale_name)
+                if os.path.lexists(stale_file_path):
+                    deleted += 1
+                    os.remove(stale_file_path)
 
+            links.wait()
 
-def create_concept(name: str, directory_path, parent_concept=None) -> Concept:
-    concept = Concept(name, directory_path, parent_concept)
+        write_sync_manifest(sync_manifest_path, planned_images, captions)
+        return placed, written, deleted, flattened
 
-    files = os.listdir(directory_path)
-    for filename in files:
-        file = os.path.join(directory_path, filename)
 
-        if os.path.isdir(file):
-            child = create_concept(filename, file, concept)
-            concept.add_child(child)
+def _pending_window(max_workers: int | None) -> int:
+    """
+    :return: how many hashes or file operations to keep in flight ahead of the consumer on a pool of ``max_workers``
+    """
+    return (max_workers or os.cpu_count() or 1) * 4
+
+
+class _LinkQueue:
+    """
+    Bounded queue of pending ``link_file`` (and caption write) futures, warns once when a link fell back to a copy.
+    """
 
-        if os.path.isfile(file):
-            extension = os.path.splitext(file)[1]
+    def __init__(self, dst: str, link_mode: LinkMode, max_pending: int):
+        self.dst = dst
+        self.link_mode = link_mode
+        self.max_pending = max_pending
 
-            if is_image(filename):
-                matching_text_filename = filename.replace(extension, ".txt")
-                text_file_path = os.path.join(
-                        directory_path, matching_text_filename)
+        self.__pending: deque[Future] = deque()
+        self.__fallback_warned = False
 
-                img_tags = []
-                if os.path.exists(text_file_path):
-                    img_tags = read_tags_from_file(text_file_path)
+    def append(self, future: Future):
+        self.__pending.append(future)
 
-                concept_img = ConceptImage(concept, file, img_tags)
-                concept.add_image(concept_img)
+        while len(self.__pending) > self.max_pending or (len(self.__pending) > 0 and self.__pending[0].done()):
+            self.__result(self.__pending.popleft())
+
+    def wait(self):
+        while len(self.__pending) > 0:
+            self.__result(self.__pending.popleft())
+
+    def __result(self, future: Future):
+        result = future.result()
+
+        if isinstance(result, LinkMode) and result is not self.link_mode and not self.__fallback_warned:
+            self.__fallback_warned = True
+            print(f"\nWARNING: Unable to {self.link_mode.value} some images into '{self.dst}', copied them instead.\n")
+
+
+def create_concept(
+        name: str,
+        directory_path,
+        parent_concept=None,
+        max_workers: int | None = None,
+        manifest: ScanManifest | None = None,
+        progress: Callable[[Concept], None] | None = None,
+        cancel_event: threading.Event | None = None
+) -> Concept | None:
+    """
+    Scans ``directory_path`` into a concept tree.
+
+    :param progress: called from the scanning threads with every concept once it and its images are loaded, parents
+        always before their children
+    :param cancel_event: stops the scan once set, directories already being read are finished first
+    :return: the root concept, or None when the scan was cancelled
+    """
+    # scanned breadth-first, one depth at a time across the thread pool; children and images are added in name order
+    # so the tree never depends on thread scheduling or directory listing order
+    concept, directories = _load_concept((name, directory_path, parent_concept, manifest))
+    child_directories = {concept: directories}
+
+    if progress is not None:
+        progress(concept)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while len(child_directories) > 0:
+            pending = [
+                (c_name, os.path.join(parent.working_directory, c_name), parent, manifest)
+                for parent, directories in child_directories.items()
+                for c_name in directories
+            ]
+
+            child_directories = {}
+            for child, directories in executor.map(_load_concept, pending):
+                if cancel_event is not None and cancel_event.is_set():
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    return None
+
+                child.parent.add_child(child)
+                child_directories[child] = directories
+
+                if progress is not None:
+                    progress(child)
 
     return concept
 
 
+def _load_concept(args: tuple[str, str, Concept | None, ScanManifest | None]) -> tuple[Concept, list[str]]:
+    name, directory_path, parent_concept, manifest = args
+    directories, images, has_prompt, has_special = _scan_concept_directory(directory_path, manifest)
+
+    raw_tags = []
+    if has_prompt:
+        raw_tags = _read_text_file(os.path.join(directory_path, "__prompt.txt"), read_tags_from_file, manifest)
+
+    special_tags_data = []
+    if has_special:
+        special_tags_data = _read_text_file(
+                os.path.join(directory_path, "__special.txt"),
+                read_special_tags_data,
+                manifest
+        )
+
+    concept = Concept(name, directory_path, parent_concept, raw_tags, parse_special_tags(special_tags_data))
+
+    for filename, matching_text_filename in images:
+        img_tags = []
+        if matching_text_filename is not None:
+            text_file_path = os.path.join(directory_path, matching_text_filename)
+            img_tags = _read_text_file(text_file_path, read_tags_from_file, manifest)
+
+        concept.add_image(ConceptImage(
+                concept,
+                os.path.join(directory_path, filename),
+                img_tags,
+                matching_text_filename is not None
+        ))
+
+    return concept, directories
+
+
+def _scan_concept_directory(
+        directory_path: str,
+        manifest: ScanManifest | None
+) -> tuple[list[str], list[tuple[str, str | None]], bool, bool]:
+    directory_mtime_ns = 0
+    if manifest is not None:
+        directory_mtime_ns = os.stat(directory_path).st_mtime_ns
+
+        listing = manifest.get_directory(directory_path, directory_mtime_ns)
+        if listing is not None:
+            directories, images, has_prompt, has_special = listing
+            return directories, [(i, t) for i, t in images], has_prompt, has_special
+
+    directories: list[str] = []
+    image_filenames: list[str] = []
+    filenames: set[str] = set()
+
+    with os.scandir(directory_path) as it:
+        for entry in it:
+            if entry.is_dir():
+                if entry.name != cache_directory_name:
+                    directories.append(entry.name)
+            elif entry.is_file():
+                filenames.add(entry.name)
+                if is_image(entry.name):
+                    image_filenames.append(entry.name)
+
+    images: list[tuple[str, str | None]] = []
+    for filename in sorted(image_filenames):
+        matching_text_filename = f"{os.path.splitext(filename)[0]}.txt"
+        images.append((filename, matching_text_filename if matching_text_filename in filenames else None))
+
+    directories.sort()
+    has_prompt = "__prompt.txt" in filenames
+    has_special = "__special.txt" in filenames
+
+    if manifest is not None:
+        manifest.put_directory(directory_path, directory_mtime_ns, [directories, images, has_prompt, has_special])
+
+    return directories, images, has_prompt, has_special
+
+
+def _read_text_file(path: str, reader, manifest: ScanManifest | None):
+    if manifest is None:
+        return reader(path)
+
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return reader(path)
+
+    content = manifest.get_file(path, stat.st_mtime_ns, stat.st_size)
+    if content is None:
+        content = reader(path)
+        manifest.put_file(path, stat.st_mtime_ns, stat.st_size, content)
+
+    return content
+
+
+def _dedup_last(tags: list[str]) -> list[str]:
+    seen: set[str] = set()
+    u_tags = []
+
+    for t in reversed(tags):
+        if t not in seen:
+            seen.add(t)
+            u_tags.append(t)
+
+    u_tags.reverse()
+    return u_tags
+
+
 def print_concept_info(concept: Concept, recursive: bool = True, indent: int = 0):
     concept_str = " │ " * (max(0, indent - 1)) + " ├─"
     print(f"{concept_str}{concept.canonical_name}")
@@ -0,0 +1,242 @@
+import bisect
+import re
+from array import array
+from collections.abc import Iterable, Iterator
+
+from fking.fking_captions import CaptionedImage
+from fking.fking_utils import tag_vocabulary
+
+__query_token = re.compile(r'\s*(?:(")((?:[^"\\]|\\.)*)"|([&|,!()])|([^&|,!()"]+))')
+
+
+class TagIndex:
+    """
+    Inverted index from tags to images.
+
+    Every image gets a dense integer id, every tag a sorted ``array('I')`` posting list of image ids. Queries run on
+    Python integers used as bitmaps, one bit per image id, built from a tag's postings the first time the tag is
+    queried and kept up to date by ``update`` afterwards, so repeated queries are a handful of big integer operations.
+
+    Query syntax: ``&`` or ``,`` for AND, ``|`` for OR, ``!`` for NOT, parentheses for grouping and double quotes
+    around tags containing any of those characters, e.g. ``long hair, !(blonde hair | "saber (fate)")``. An empty
+    query matches every image.
+    """
+
+    def __init__(self):
+        self.keys: list[str | None] = []
+
+        self.__ids: dict[str, int] = {}
+        self.__image_tags: list[array] = []
+        self.__postings: dict[int, array] = {}
+        self.__bitmaps: dict[int, int] = {}
+        self.__all = 0
+
+    def __len__(self) -> int:
+        return len(self.__ids)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.__ids
+
+    @staticmethod
+    def from_captioned_images(captioned_images: Iterable[CaptionedImage], use_paths: bool = False) -> "TagIndex":
+        """
+        Builds an index of flattened images keyed by their canonical name, or by their path with ``use_paths``.
+        """
+        tag_index = TagIndex()
+
+        for img in captioned_images:
+            tag_index.__add(img.path if use_paths else img.get_canonical_name(), img.tag_ids)
+
+        return tag_index
+
+    def get_tags(self, key: str) -> list[str]:
+        image_id = self.__ids.get(key)
+        return [] if image_id is None else tag_vocabulary.get_tags(self.__image_tags[image_id])
+
+    def update(self, key: str, tags: list[str]):
+        """
+        Sets the tags of the image ``key``, adding it to the index if needed. Only the postings of tags that were
+        added or removed are touched.
+        """
+        tag_ids = tag_vocabulary.intern_all(tags)
+
+        image_id = self.__ids.get(key)
+        if image_id is None:
+            self.__add(key, tag_ids)
+            return
+
+        old_tag_ids = set(self.__image_tags[image_id])
+        new_tag_ids = set(tag_ids)
+
+        for tag_id in old_tag_ids - new_tag_ids:
+            self.__remove_posting(tag_id, image_id)
+
+        for tag_id in new_tag_ids - old_tag_ids:
+            self.__add_posting(tag_id, image_id)
+
+        self.__image_tags[image_id] = tag_ids
+
+    def remove(self, key: str):
+        image_id = self.__ids.pop(key, None)
+        if image_id is None:
+            return
+
+        for tag_id in set(self.__image_tags[image_id]):
+            self.__remove_posting(tag_id, image_id)
+
+        self.keys[image_id] = None
+        self.__image_tags[image_id] = array('I')
+        self.__all &= ~(1 << image_id)
+
+    def query(self, expression: str) -> int:
+        """
+        :return: bitmap of the ids of all images matching ``expression``
+        """
+        tokens = _tokenize_query(expression)
+        if len(tokens) <= 0:
+            return self.__all
+
+        bitmap, position = self.__parse_or(tokens, 0)
+        if position < len(tokens):
+            raise ValueError(f"Unexpected '{tokens[position][1]}' in tag query '{expression}'.")
+
+        return bitmap
+
+    def query_keys(self, expression: str) -> list[str]:
+        return [self.keys[i] for i in iter_bitmap(self.query(expression))]
+
+    def __add(self, key: str, tag_ids: array):
+        image_id = len(self.keys)
+
+        self.__ids[key] = image_id
+        self.keys.append(key)
+        self.__image_tags.append(tag_ids)
+        self.__all |= 1 << image_id
+
+        postings = self.__postings
+        for tag_id in set(tag_ids):
+            tag_postings = postings.get(tag_id)
+            if tag_postings is None:
+                tag_postings = postings[tag_id] = array('I')
+
+            # ids are handed out in increasing order, appending keeps postings sorted
+            tag_postings.append(image_id)
+
+        if len(self.__bitmaps) > 0:
+            for tag_id in set(tag_ids):
+                if tag_id in self.__bitmaps:
+                    self.__bitmaps[tag_id] |= 1 << image_id
+
+    def __add_posting(self, tag_id: int, image_id: int):
+        tag_postings = self.__postings.get(tag_id)
+        if tag_postings is None:
+            tag_postings = self.__postings[tag_id] = array('I')
+
+        tag_postings.insert(bisect.bisect_left(tag_postings, image_id), image_id)
+
+        if tag_id in self.__bitmaps:
+            self.__bitmaps[tag_id] |= 1 << image_id
+
+    def __remove_posting(self, tag_id: int, image_id: int):
+        tag_postings = self.__postings[tag_id]
+        del tag_postings[bisect.bisect_left(tag_postings, image_id)]
+
+        if tag_id in self.__bitmaps:
+            self.__bitmaps[tag_id] &= ~(1 << image_id)
+
+    def __tag_bitmap(self, tag: str) -> int:
+        tag_id = tag_vocabulary.get_id(tag)
+        if tag_id is None:
+            return 0
+
+        bitmap = self.__bitmaps.get(tag_id)
+        if bitmap is None:
+            bitmap = self.__bitmaps[tag_id] = _to_bitmap(self.__postings.get(tag_id, ()), len(self.keys))
+
+        return bitmap
+
+    def __parse_or(self, tokens: list[tuple[str, str]], position: int) -> tuple[int, int]:
+        bitmap, position = self.__parse_and(tokens, position)
+
+        while position < len(tokens) and tokens[position] == ("op", "|"):
+            right, position = self.__parse_and(tokens, position + 1)
+            bitmap |= right
+
+        return bitmap, position
+
+    def __parse_and(self, tokens: list[tuple[str, str]], position: int) -> tuple[int, int]:
+        bitmap, position = self.__parse_not(tokens, position)
+
+        while position < len(tokens) and tokens[position] in (("op", "&"), ("op", ",")):
+            right, position = self.__parse_not(tokens, position + 1)
+            bitmap &= right
+
+        return bitmap, position
+
+    def __parse_not(self, tokens: list[tuple[str, str]], position: int) -> tuple[int, int]:
+        if position >= len(tokens):
+            raise ValueError("Unexpected end of tag query.")
+
+        kind, value = tokens[position]
+
+        if (kind, value) == ("op", "!"):
+            bitmap, position = self.__parse_not(tokens, position + 1)
+            return self.__all & ~bitmap, position
+
+        if (kind, value) == ("op", "("):
+            bitmap, position = self.__parse_or(tokens, position + 1)
+            if position >= len(tokens) or tokens[position] != ("op", ")"):
+                raise ValueError("Missing ')' in tag query.")
+
+            return bitmap, position + 1
+
+        if kind == "tag":
+            return self.__tag_bitmap(value), position + 1
+
+        raise ValueError(f"Unexpected '{value}' in tag query.")
+
+
+def iter_bitmap(bitmap: int) -> Iterator[int]:
+    """
+    Yields the positions of all set bits of ``bitmap`` in increasing order.
+    """
+    offset = 0
+    for byte in bitmap.to_bytes((bitmap.bit_length() + 7) // 8, "little"):
+        while byte:
+            low_bit = byte & -byte
+            yield offset + low_bit.bit_length() - 1
+            byte ^= low_bit
+
+        offset += 8
+
+
+def _to_bitmap(ids: Iterable[int], size: int) -> int:
+    bitmap = bytearray((size + 7) // 8)
+    for i in ids:
+        bitmap[i >> 3] |= 1 << (i & 7)
+
+    return int.from_bytes(bitmap, "little")
+
+
+def _tokenize_query(expression: str) -> list[tuple[str, str]]:
+    tokens = []
+
+    position = 0
+    expression = expression.strip()
+
+    while position < len(expression):
+        match = __query_token.match(expression, position)
+        if match is None:
+            raise ValueError(f"Unable to parse tag query '{expression}'.")
+
+        quote, quoted, operator, tag = match.groups()
+        if quote is not None:
+            tokens.append(("tag", re.sub(r"\\(.)", r"\1", quoted).strip()))
+        elif operator is not None:
+            tokens.append(("op", operator))
+        elif tag.strip():
+            tokens.append(("tag", tag.strip()))
+
+        position = match.end()
+
+    return tokens
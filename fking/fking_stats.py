@@ -0,0 +1,318 @@
+import csv
+import json
+import os
+from array import array
+from collections.abc import Iterable, Iterator
+
+import numpy as np
+
+from fking.fking_captions import CaptionedImage
+from fking.fking_utils import tag_vocabulary
+
+# tag and concept ids are packed into one int64 code, high word first, so pairs can be counted with np.unique
+_id_bits = 32
+_id_mask = (1 << _id_bits) - 1
+
+# upper bound of codes generated at once, keeps co-occurrence batches of long captions in memory
+_max_batch_codes = 1 << 22
+
+# largest dense pair table counted per batch, 16M int64 counts
+_max_dense_pairs = 1 << 24
+
+
+class TagAnalytics:
+    """
+    Dataset-level tag analytics over resolved captions, built in batches with NumPy.
+
+    Tags are the integer ids of the interned tag vocabulary captions already carry, concepts are numbered as they are
+    first seen. Every ``batch_size`` captions the batch is turned into tag counts, concept/tag counts and tag
+    co-occurrence counts, the latter two kept sparse as sorted ``(code, count)`` arrays.
+    """
+
+    def __init__(self, batch_size: int = 65536):
+        self.batch_size = batch_size
+
+        self.concepts: list[str] = []
+        self.image_count = 0
+
+        self.__concept_ids: dict[str, int] = {}
+
+        self.__batch_tags = array('I')
+        self.__batch_offsets = array('q', [0])
+        self.__batch_concepts = array('q')
+
+        self.__tag_counts = np.zeros(0, dtype=np.int64)
+        self.__concept_image_counts = np.zeros(0, dtype=np.int64)
+        self.__concept_tag_counts = _SparseCounts()
+        self.__pair_counts = _SparseCounts()
+
+    @property
+    def tags(self) -> list[str]:
+        return tag_vocabulary.get_tags(range(len(tag_vocabulary)))
+
+    def add(self, concept_name: str, tag_ids: Iterable[int]):
+        concept_id = self.__concept_ids.get(concept_name)
+        if concept_id is None:
+            concept_id = self.__concept_ids[concept_name] = len(self.concepts)
+            self.concepts.append(concept_name)
+
+        self.__batch_tags.extend(tag_ids)
+        self.__batch_offsets.append(len(self.__batch_tags))
+        self.__batch_concepts.append(concept_id)
+        self.image_count += 1
+
+        if len(self.__batch_concepts) >= self.batch_size:
+            self.__flush()
+
+    def add_all(self, captioned_images: Iterable[CaptionedImage]) -> "TagAnalytics":
+        for img in captioned_images:
+            self.add(img.concept.canonical_name, img.tag_ids)
+
+        self.__flush()
+        return self
+
+    def __flush(self):
+        if len(self.__batch_concepts) <= 0:
+            return
+
+        tags = np.frombuffer(self.__batch_tags, dtype=np.uint32).astype(np.int64)
+        offsets = np.array(self.__batch_offsets, dtype=np.int64)
+        concepts = np.array(self.__batch_concepts, dtype=np.int64)
+        lengths = np.diff(offsets)
+
+        self.__batch_tags = array('I')
+        self.__batch_offsets = array('q', [0])
+        self.__batch_concepts = array('q')
+
+        self.__tag_counts = _add_counts(self.__tag_counts, np.bincount(tags, minlength=len(tag_vocabulary)))
+        self.__concept_image_counts = _add_counts(
+                self.__concept_image_counts,
+                np.bincount(concepts, minlength=len(self.concepts))
+        )
+
+        entry_concepts = np.repeat(concepts, lengths)
+        self.__concept_tag_counts.add((entry_concepts << _id_bits) | tags)
+
+        # with few distinct tags in the batch, pairs are counted into a dense triangle with bincount instead of sorting
+        used_tags, compact_tags = np.unique(tags, return_inverse=True)
+        used_count = len(used_tags)
+
+        if used_count * used_count <= _max_dense_pairs:
+            # counted chunk by chunk, so no more than _max_batch_codes pair codes exist at once
+            dense_counts = np.zeros(used_count * used_count, dtype=np.int64)
+            for a, b in _iter_tag_pairs(compact_tags.ravel(), offsets, lengths):
+                chunk_counts = np.bincount(a * used_count + b)
+                dense_counts[:len(chunk_counts)] += chunk_counts
+
+            pairs = np.flatnonzero(dense_counts)
+            self.__pair_counts.add(
+                    (used_tags[pairs // used_count] << _id_bits) | used_tags[pairs % used_count],
+                    dense_counts[pairs]
+            )
+        else:
+            for a, b in _iter_tag_pairs(tags, offsets, lengths):
+                self.__pair_counts.add((a << _id_bits) | b)
+
+    def get_tag_counts(self) -> np.ndarray:
+        self.__flush()
+        return _add_counts(self.__tag_counts, np.zeros(len(tag_vocabulary), dtype=np.int64))
+
+    def count_tags(self) -> int:
+        return int(np.count_nonzero(self.get_tag_counts()))
+
+    def get_concept_image_counts(self) -> np.ndarray:
+        self.__flush()
+        return _add_counts(self.__concept_image_counts, np.zeros(len(self.concepts), dtype=np.int64))
+
+    def get_concept_tag_counts(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        :return: concept ids, tag ids and image counts of every concept/tag combination
+        """
+        self.__flush()
+
+        codes, counts = self.__concept_tag_counts.get()
+        return codes >> _id_bits, codes & _id_mask, counts
+
+    def get_tag_concept_counts(self) -> np.ndarray:
+        """
+        :return: number of distinct concepts using each tag
+        """
+        concept_ids, tag_ids, counts = self.get_concept_tag_counts()
+        return np.bincount(tag_ids, minlength=len(tag_vocabulary))
+
+    def get_cooccurrence(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        :return: tag ids ``a < b`` and the number of images carrying both, for every pair that occurs at all
+        """
+        self.__flush()
+
+        codes, counts = self.__pair_counts.get()
+        return codes >> _id_bits, codes & _id_mask, counts
+
+    def get_rare_tags(self, threshold: int = 1) -> np.ndarray:
+        """
+        :return: ids of tags used by at most ``threshold`` images, least used first
+        """
+        tag_counts = self.get_tag_counts()
+
+        rare = np.flatnonzero((tag_counts > 0) & (tag_counts <= threshold))
+        return rare[np.argsort(tag_counts[rare], kind="stable")]
+
+    def write(self, dst: str, rare_threshold: int = 1, top: int = 100):
+        """
+        Writes ``tags.csv``, ``concept_tags.csv``, ``cooccurrence.csv``, ``rare_tags.csv`` and a ``report.json``
+        summary to ``dst``.
+        """
+        os.makedirs(dst, exist_ok=True)
+
+        tags = np.array(self.tags, dtype=object)
+        concepts = np.array(self.concepts, dtype=object)
+
+        tag_counts = self.get_tag_counts()
+        tag_concept_counts = self.get_tag_concept_counts()
+        tag_order = np.lexsort((np.arange(len(tags)), -tag_concept_counts, -tag_counts))
+        tag_order = tag_order[tag_counts[tag_order] > 0]
+
+        _write_csv(
+                os.path.join(dst, "tags.csv"),
+                ("tag", "count", "concepts", "share"),
+                zip(tags[tag_order], tag_counts[tag_order], tag_concept_counts[tag_order],
+                    np.round(tag_counts[tag_order] / max(1, self.image_count), 6))
+        )
+
+        concept_image_counts = self.get_concept_image_counts()
+        concept_ids, concept_tag_ids, concept_tag_counts = self.get_concept_tag_counts()
+        concept_order = np.lexsort((-concept_tag_counts, concept_ids))
+
+        _write_csv(
+                os.path.join(dst, "concept_tags.csv"),
+                ("concept", "tag", "count", "share"),
+                zip(concepts[concept_ids[concept_order]], tags[concept_tag_ids[concept_order]],
+                    concept_tag_counts[concept_order],
+                    np.round(concept_tag_counts[concept_order] / concept_image_counts[concept_ids[concept_order]], 6))
+        )
+
+        pair_a, pair_b, pair_counts = self.get_cooccurrence()
+        pair_order = np.argsort(-pair_counts, kind="stable")
+
+        _write_csv(
+                os.path.join(dst, "cooccurrence.csv"),
+                ("tag_a", "tag_b", "count"),
+                zip(tags[pair_a[pair_order]], tags[pair_b[pair_order]], pair_counts[pair_order])
+        )
+
+        rare_tags = self.get_rare_tags(rare_threshold)
+
+        _write_csv(
+                os.path.join(dst, "rare_tags.csv"),
+                ("tag", "count", "concepts"),
+                zip(tags[rare_tags], tag_counts[rare_tags], tag_concept_counts[rare_tags])
+        )
+
+        report = {
+            "images": self.image_count,
+            "concepts": len(self.concepts),
+            "tags": len(tag_order),
+            "tag_pairs": len(pair_counts),
+            "rare_threshold": rare_threshold,
+            "rare_tags": len(rare_tags),
+            "top_tags": [
+                {"tag": tags[i], "count": int(tag_counts[i]), "concepts": int(tag_concept_counts[i])}
+                for i in tag_order[:top]
+            ],
+            "top_pairs": [
+                {"tags": [tags[pair_a[i]], tags[pair_b[i]]], "count": int(pair_counts[i])}
+                for i in pair_order[:top]
+            ]
+        }
+
+        with open(os.path.join(dst, "report.json"), "w+") as f:
+            json.dump(report, f, indent=2)
+            f.close()
+
+
+class _SparseCounts:
+    """
+    Counts of int64 codes, kept as sorted unique codes with their counts and consolidated as batches come in.
+    """
+
+    def __init__(self, max_pending: int = 1 << 24):
+        self.max_pending = max_pending
+
+        self.__codes: list[np.ndarray] = []
+        self.__counts: list[np.ndarray] = []
+        self.__pending = 0
+
+    def add(self, codes: np.ndarray, counts: np.ndarray | None = None):
+        if counts is None:
+            codes, counts = np.unique(codes, return_counts=True)
+
+        self.__codes.append(codes)
+        self.__counts.append(counts.astype(np.int64, copy=False))
+        self.__pending += len(codes)
+
+        if self.__pending > self.max_pending:
+            self.__consolidate()
+
+    def get(self) -> tuple[np.ndarray, np.ndarray]:
+        self.__consolidate()
+
+        if len(self.__codes) <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        return self.__codes[0], self.__counts[0]
+
+    def __consolidate(self):
+        if len(self.__codes) <= 1:
+            return
+
+        codes, inverse = np.unique(np.concatenate(self.__codes), return_inverse=True)
+        counts = np.bincount(inverse.ravel(), weights=np.concatenate(self.__counts)).astype(np.int64)
+
+        self.__codes = [codes]
+        self.__counts = [counts]
+        self.__pending = len(codes)
+
+
+def _iter_tag_pairs(
+        tags: np.ndarray,
+        offsets: np.ndarray,
+        lengths: np.ndarray
+) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+    """
+    Yields every tag pair of every caption in chunks, smaller id first.
+    """
+    # captions of equal length are stacked into a matrix, the upper triangle of each row gives its tag pairs
+    for length in np.unique(lengths):
+        if length < 2:
+            continue
+
+        documents = np.flatnonzero(lengths == length)
+        rows, cols = np.triu_indices(length, 1)
+        step = max(1, _max_batch_codes // len(rows))
+
+        for start in range(0, len(documents), step):
+            document_offsets = offsets[documents[start:start + step]]
+            matrix = tags[document_offsets[:, None] + np.arange(length)]
+
+            a = matrix[:, rows].ravel()
+            b = matrix[:, cols].ravel()
+
+            yield np.minimum(a, b), np.maximum(a, b)
+
+
+def _add_counts(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    if len(a) < len(b):
+        a = np.pad(a, (0, len(b) - len(a)))
+    elif len(b) < len(a):
+        b = np.pad(b, (0, len(a) - len(b)))
+
+    return a + b
+
+
+def _write_csv(path: str, header: tuple, rows):
+    with open(path, "w+", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+        f.close()
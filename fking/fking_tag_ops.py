@@ -0,0 +1,207 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+
+from fking.fking_captions import Concept, ConceptImage
+from fking.fking_utils import normalize_tags, write_tags
+
+
+class TagOperationMode(Enum):
+    RENAME = "rename"
+    REPLACE = "replace"
+    DELETE = "delete"
+    ADD_IF_HAS = "add-if-has"
+
+
+class TagOperation:
+    """
+    One bulk edit of the tags written in ``__prompt.txt`` and image caption files.
+
+    ``RENAME`` swaps ``tag`` for ``tags`` where it stands, ``REPLACE`` replaces the text ``tag`` with ``tags[0]`` inside
+    every tag containing it, ``DELETE`` removes ``tag`` and ``ADD_IF_HAS`` appends ``tags`` to every file containing
+    ``tag``.
+
+    ``__folder__`` and special tags are never renamed, rewritten or deleted, they are resolved from the hierarchy and
+    editing them in bulk would change what every image below them gets.
+    """
+
+    def __init__(self, mode: TagOperationMode, tag: str, tags: list[str] | None = None):
+        self.mode = mode
+        self.tag = tag.strip()
+        self.tags = normalize_tags(tags if tags is not None else [])
+
+        if len(self.tag) <= 0:
+            raise ValueError(f"Missing tag for {mode.value} operation.")
+
+        if mode is not TagOperationMode.ADD_IF_HAS and is_reserved_tag(self.tag):
+            raise ValueError(f"Unable to {mode.value} reserved tag '{self.tag}'.")
+
+        if mode is TagOperationMode.REPLACE and len(self.tags) > 1:
+            raise ValueError(f"Unable to replace '{self.tag}' with more than one tag.")
+
+        if mode in (TagOperationMode.RENAME, TagOperationMode.ADD_IF_HAS) and len(self.tags) <= 0:
+            raise ValueError(f"Missing new tags for {mode.value} operation on '{self.tag}'.")
+
+    def __str__(self) -> str:
+        return f"{self.mode.value} '{self.tag}'" + (f" -> '{', '.join(self.tags)}'" if len(self.tags) > 0 else "")
+
+
+class TagFileIndex:
+    """
+    Index of which ``__prompt.txt`` and caption files contain which raw tags, so a bulk operation only looks at the
+    files it can change.
+
+    Files are numbered in hierarchy order, each remembers the concept or image it was loaded into so the in-memory
+    tree can be kept in step with the files.
+    """
+
+    def __init__(self):
+        self.paths: list[str] = []
+        self.owners: list[Concept | ConceptImage] = []
+        self.tags: list[list[str]] = []
+
+        self.__postings: dict[str, set[int]] = {}
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    @staticmethod
+    def from_concept(concept: Concept) -> "TagFileIndex":
+        tag_file_index = TagFileIndex()
+
+        stack = [concept]
+        while len(stack) > 0:
+            c = stack.pop()
+
+            if len(c.raw_tags) > 0:
+                tag_file_index.add(os.path.join(c.working_directory, "__prompt.txt"), c, c.raw_tags)
+
+            for img in c.images:
+                img_tags = img.tags
+                if len(img_tags) > 0:
+                    tag_file_index.add(
+                            os.path.join(c.working_directory, f"{img.get_filename(0)}.txt"),
+                            img,
+                            img_tags
+                    )
+
+            stack.extend(reversed(c.children))
+
+        return tag_file_index
+
+    def add(self, path: str, owner: Concept | ConceptImage, tags: list[str]):
+        file_id = len(self.paths)
+
+        self.paths.append(path)
+        self.owners.append(owner)
+        self.tags.append(tags)
+
+        for t in tags:
+            self.__postings.setdefault(t, set()).add(file_id)
+
+    def get_files(self, tag: str) -> set[int]:
+        return self.__postings.get(tag, set())
+
+    def find_tags(self, text: str) -> list[str]:
+        """
+        :return: every indexed tag containing ``text``
+        """
+        return [t for t, file_ids in self.__postings.items() if text in t and len(file_ids) > 0]
+
+    def set_tags(self, file_id: int, tags: list[str]):
+        for t in self.tags[file_id]:
+            self.__postings[t].discard(file_id)
+
+        for t in tags:
+            self.__postings.setdefault(t, set()).add(file_id)
+
+        self.tags[file_id] = tags
+
+
+def is_reserved_tag(tag: str) -> bool:
+    return "__folder__" in tag or (len(tag) > 4 and tag.startswith("__") and tag.endswith("__"))
+
+
+def apply_tag_operations(
+        tag_file_index: TagFileIndex,
+        operations: list[TagOperation],
+        dry_run: bool = False,
+        max_workers: int | None = None
+) -> list[tuple[str, list[str], list[str]]]:
+    """
+    Applies ``operations`` in order to the indexed files. Only files whose tags end up different are written, in
+    parallel and atomically, and the concepts and images they belong to are updated to match.
+
+    :return: the path, old tags and new tags of every changed file, or of every file that would change with ``dry_run``
+    """
+    original_tags: dict[int, list[str]] = {}
+
+    for operation in operations:
+        for file_id in sorted(_get_operation_files(tag_file_index, operation)):
+            tags = tag_file_index.tags[file_id]
+            new_tags = normalize_tags(_apply_operation(operation, tags))
+
+            if new_tags != tags:
+                original_tags.setdefault(file_id, tags)
+                tag_file_index.set_tags(file_id, new_tags)
+
+    changed_files = [
+        file_id for file_id, tags in sorted(original_tags.items())
+        if tag_file_index.tags[file_id] != tags
+    ]
+
+    changes = [
+        (tag_file_index.paths[file_id], original_tags[file_id], tag_file_index.tags[file_id])
+        for file_id in changed_files
+    ]
+
+    if dry_run or len(changes) <= 0:
+        return changes
+
+    with ThreadPoolExecutor(max_workers) as executor:
+        # list() so the first failed write is raised here
+        list(executor.map(lambda change: write_tags(change[0], change[2], atomic=True), changes))
+
+    for file_id in changed_files:
+        owner = tag_file_index.owners[file_id]
+        if isinstance(owner, Concept):
+            owner.set_raw_tags(tag_file_index.tags[file_id])
+        else:
+            owner.tags = tag_file_index.tags[file_id]
+
+    return changes
+
+
+def _get_operation_files(tag_file_index: TagFileIndex, operation: TagOperation) -> set[int]:
+    if operation.mode is TagOperationMode.REPLACE:
+        file_ids = set()
+        for t in tag_file_index.find_tags(operation.tag):
+            if not is_reserved_tag(t):
+                file_ids.update(tag_file_index.get_files(t))
+
+        return file_ids
+
+    return set(tag_file_index.get_files(operation.tag))
+
+
+def _apply_operation(operation: TagOperation, tags: list[str]) -> list[str]:
+    mode = operation.mode
+
+    if mode is TagOperationMode.RENAME:
+        new_tags = []
+        for t in tags:
+            new_tags.extend(operation.tags if t == operation.tag else (t,))
+
+        return new_tags
+
+    if mode is TagOperationMode.REPLACE:
+        replacement = operation.tags[0] if len(operation.tags) > 0 else ""
+        return [t if is_reserved_tag(t) else t.replace(operation.tag, replacement) for t in tags]
+
+    if mode is TagOperationMode.DELETE:
+        return [t for t in tags if t != operation.tag]
+
+    if mode is TagOperationMode.ADD_IF_HAS:
+        return tags + operation.tags if operation.tag in tags else tags
+
+    raise ValueError(f"Unknown tag operation '{mode}'.")
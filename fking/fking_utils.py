@@ -1,10 +1,18 @@
+import bisect
 import hashlib
 import json
+import math
 import os
-import pathlib
-
+import re
+import shutil
+import threading
+from array import array
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 
+from fking.fking_cache import atomic_replace, cache_directory_name
+
 
 class SpecialTagMergeMode(Enum):
     MERGE = 1
@@ -12,18 +20,72 @@ class SpecialTagMergeMode(Enum):
     KEEP_EXISTING = 3
 
 
+class LinkMode(Enum):
+    COPY = "copy"
+    HARDLINK = "hardlink"
+    REFLINK = "reflink"
+    SYMLINK = "symlink"
+
+
 __img_extensions = [".png", ".jpeg", ".jpg"]
 
+# linux/fs.h _IOW(0x94, 9, int)
+__ficlone = 0x40049409
 
-def read_tags_from_file(path: str) -> list[str]:
-    if not os.path.exists(path):
-        return []
 
-    with open(path) as f:
-        tags = []
+class TagVocabulary:
+    """
+    Process-wide interned tag vocabulary, every distinct tag is stored once and referenced by its integer id.
+    """
 
-        lines = f.readlines()
-        f.close()
+    def __init__(self):
+        self.__ids: dict[str, int] = {}
+        self.__tags: list[str] = []
+        self.__lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.__tags)
+
+    def intern(self, tag: str) -> int:
+        tag_id = self.__ids.get(tag)
+        if tag_id is not None:
+            return tag_id
+
+        with self.__lock:
+            tag_id = self.__ids.get(tag)
+            if tag_id is None:
+                tag_id = len(self.__tags)
+                self.__tags.append(tag)
+                self.__ids[tag] = tag_id
+
+        return tag_id
+
+    def intern_all(self, tags: list[str]) -> array:
+        return array('I', [self.intern(t) for t in tags])
+
+    def get_id(self, tag: str) -> int | None:
+        return self.__ids.get(tag)
+
+    def get_tag(self, tag_id: int) -> str:
+        return self.__tags[tag_id]
+
+    def get_tags(self, tag_ids) -> list[str]:
+        tags = self.__tags
+        return [tags[i] for i in tag_ids]
+
+
+tag_vocabulary = TagVocabulary()
+
+
+def read_tags_from_file(path: str) -> list[str]:
+    try:
+        with open(path) as f:
+            tags = []
+
+            lines = f.readlines()
+            f.close()
+    except FileNotFoundError:
+        return []
 
     for line in lines:
         tags.extend(line.split(','))
@@ -34,9 +96,16 @@ def read_tags_from_file(path: str) -> list[str]:
     return normalize_tags(tags)
 
 
-def sha256_file_hash(path: str) -> str:
-    file_bytes = pathlib.Path(path).read_bytes()
-    return hashlib.sha256(file_bytes).hexdigest()
+def sha256_file_hash(path: str, chunk_size: int = 1024 * 1024) -> str:
+    # streamed in chunks so memory stays flat regardless of image size, hashlib releases the gil while hashing each
+    # chunk so this also scales across threads
+    file_hash = hashlib.sha256()
+
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            file_hash.update(chunk)
+
+    return file_hash.hexdigest()
 
 
 def normalize_tags(tags: list[str]) -> list[str]:
@@ -56,35 +125,69 @@ def normalize_tags(tags: list[str]) -> list[str]:
 def write_tags(
         dst: str,
         tags: list[str],
-        special_tags: dict[str, tuple[SpecialTagMergeMode, list[str]]] = {}
+        special_tags: dict[str, tuple[SpecialTagMergeMode, list[str]]] = {},
+        atomic: bool = False,
+        expansions: dict[str, tuple[str, ...]] | None = None
 ) -> tuple[str, list[str]]:
+    """
+    Writes ``tags`` as one comma separated line, with special tags replaced. Pass the compiled ``expansions`` of a
+    concept, ``Concept.get_special_expansions``, instead of ``special_tags`` when writing many files of it.
+
+    :return: the line written and its tags
+    """
     dst = os.path.abspath(dst)
-    with open(dst, 'w+') as f:
+    if expansions is not None:
+        t_tags = expand_special_tags(tags, expansions)
+    else:
         t_tags = find_and_replace_special_tags(tags, special_tags)
-        line = ", ".join(t_tags)
+    line = ", ".join(t_tags)
 
-        # print(f"Saving '{line}' to '{dst}'.")
+    # print(f"Saving '{line}' to '{dst}'.")
 
-        f.write(line)
-        f.close()
+    if not atomic:
+        with open(dst, 'w+') as f:
+            f.write(line)
+            f.close()
 
         return line, t_tags
 
+    with atomic_replace(dst) as tmp_path:
+        with open(tmp_path, 'x') as f:
+            f.write(line)
+            f.close()
+
+    return line, t_tags
+
 
 def read_special_tags_from_file(path: str) -> dict[str, tuple[SpecialTagMergeMode, list[str]]]:
-    if not os.path.exists(path):
-        return {}
+    return parse_special_tags(read_special_tags_data(path))
 
-    special_tags: dict[str, tuple[SpecialTagMergeMode, list[str]]] = {}
 
-    with open(path) as f:
-        special_tags_data = json.load(f)
-        f.close()
+def read_special_tags_data(path: str) -> list[dict]:
+    try:
+        with open(path) as f:
+            special_tags_data = json.load(f)
+            f.close()
+    except FileNotFoundError:
+        return []
+
+    return special_tags_data
+
+
+def parse_special_tags(special_tags_data: list[dict]) -> dict[str, tuple[SpecialTagMergeMode, list[str]]]:
+    special_tags: dict[str, tuple[SpecialTagMergeMode, list[str]]] = {}
 
     for special_tag in special_tags_data:
         special = special_tag['special_tag']
         tags = special_tag['tags'].split(',')
-        mode = SpecialTagMergeMode.MERGE if 'merge_mode' not in special_tag else special_tag['merge_mode']
+
+        # documented as 'mode', older files use 'merge_mode'
+        mode = special_tag.get('mode', special_tag.get('merge_mode', SpecialTagMergeMode.MERGE.value))
+        try:
+            mode = SpecialTagMergeMode(mode)
+        except ValueError:
+            print(f"\nWARNING: Unknown mode '{mode}' for special tag '{special}', merging instead.\n")
+            mode = SpecialTagMergeMode.MERGE
 
         s_tag = mode, normalize_tags(tags)
         special_tags[special] = s_tag
@@ -96,30 +199,87 @@ def merge_special_tags(
         src: dict[str, tuple[SpecialTagMergeMode, list[str]]],
         dst: dict[str, tuple[SpecialTagMergeMode, list[str]]]
 ) -> dict[str, tuple[SpecialTagMergeMode, list[str]]]:
-    merged: dict[str, tuple[SpecialTagMergeMode, list[str]]] = dst
-
+    """
+    Merges a parent's effective special tags ``src`` with a child's own ``dst``. Special tags only the parent defines
+    are inherited, those both define are combined according to the child's mode. Neither table is modified.
+    """
     if len(dst) <= 0:
         return src
 
-    for src_special in src:
-        src_mode, src_tags = src[src_special]
+    merged: dict[str, tuple[SpecialTagMergeMode, list[str]]] = dict(src)
 
-        if src_special in merged:
-            dst_mode, dst_tags = merged[src_special]
+    for dst_special, (dst_mode, dst_tags) in dst.items():
+        if dst_special not in src:
+            merged[dst_special] = dst_mode, dst_tags
+            continue
 
-            if dst_mode is SpecialTagMergeMode.MERGE:
-                tags = normalize_tags(src_tags + dst_tags)
-                merged[src_special] = (dst_mode, tags)
+        src_mode, src_tags = src[dst_special]
 
-            elif dst_mode is SpecialTagMergeMode.REPLACE:
-                merged[src_special] = (dst_mode, src_tags)
+        if dst_mode is SpecialTagMergeMode.MERGE:
+            merged[dst_special] = dst_mode, normalize_tags(src_tags + dst_tags)
 
-            elif dst_mode is SpecialTagMergeMode.KEEP_EXISTING:
-                pass
+        elif dst_mode is SpecialTagMergeMode.REPLACE:
+            merged[dst_special] = dst_mode, src_tags
+
+        elif dst_mode is SpecialTagMergeMode.KEEP_EXISTING:
+            merged[dst_special] = dst_mode, dst_tags
 
     return merged
 
 
+def compile_special_tags(
+        special_tags: dict[str, tuple[SpecialTagMergeMode, list[str]]]
+) -> dict[str, tuple[str, ...]]:
+    """
+    Compiles a special tag table into a flat expansion map. Special tags used inside other special tags are expanded
+    in place, a special tag that ends up referencing itself is reported and left out of its own expansion.
+    """
+    expansions: dict[str, tuple[str, ...]] = {}
+
+    def expand(special: str, visiting: list[str]) -> tuple[str, ...]:
+        if special in expansions:
+            return expansions[special]
+
+        visiting.append(special)
+
+        expanded: list[str] = []
+        for t in special_tags[special][1]:
+            if t not in special_tags:
+                expanded.append(t)
+            elif t in visiting:
+                cycle = " -> ".join(visiting[visiting.index(t):] + [t])
+                print(f"\nWARNING: Special tag cycle {cycle}, leaving '{t}' out of '{special}'.\n")
+            else:
+                expanded.extend(expand(t, visiting))
+
+        visiting.pop()
+
+        expansions[special] = tuple(normalize_tags(expanded))
+        return expansions[special]
+
+    for s in special_tags:
+        expand(s, [])
+
+    return expansions
+
+
+def expand_special_tags(tags: list[str], expansions: dict[str, tuple[str, ...]]) -> list[str]:
+    """
+    Normalizes ``tags`` and replaces every special tag by its compiled expansion, one dict lookup per tag.
+    """
+    seen: set[str] = set()
+    u_tags = []
+
+    for t in tags:
+        t = t.strip()
+        for r in expansions.get(t, (t,)):
+            if len(r) > 0 and r not in seen:
+                seen.add(r)
+                u_tags.append(r)
+
+    return u_tags
+
+
 def find_and_replace_special_tags(
         tags: list[str],
         special_tags: dict[str, tuple[SpecialTagMergeMode, list[str]]]
@@ -127,27 +287,47 @@ def find_and_replace_special_tags(
     if len(special_tags) <= 0:
         return normalize_tags(tags)
 
-    replaced_tags = []
-    for t in tags:
-        if t in special_tags:
-            replaced_tags.extend(special_tags[t][1])
-        else:
-            replaced_tags.append(t)
+    return expand_special_tags(tags, compile_special_tags(special_tags))
 
-    return normalize_tags(replaced_tags)
 
+def fix_prompt_text_files(target: str, dry_run: bool = False, max_workers: int | None = None) -> list[str]:
+    """
+    Normalizes every prompt and caption text file below ``target`` in a single walk, on a thread pool. Files that are
+    already normalized are left untouched.
+
+    :return: the files that were changed, or that would be changed with ``dry_run``
+    """
+    tag_file_paths = []
 
-def fix_prompt_text_files(target: str):
     for root, dirs, files in os.walk(target):
-        for child_dir in dirs:
-            child_dir_path = os.path.join(root, child_dir)
-            fix_prompt_text_files(child_dir_path)
+        if cache_directory_name in dirs:
+            dirs.remove(cache_directory_name)
 
         for file in files:
             if not file.startswith("__special") and file.endswith(".txt"):
-                tag_file_path = os.path.join(root, file)
-                tags = read_tags_from_file(tag_file_path)
-                write_tags(tag_file_path, tags)
+                tag_file_paths.append(os.path.join(root, file))
+
+    with ThreadPoolExecutor(max_workers) as executor:
+        fixed = executor.map(lambda p: __fix_prompt_text_file(p, dry_run), tag_file_paths)
+        return [p for p, changed in zip(tag_file_paths, fixed) if changed]
+
+
+def __fix_prompt_text_file(path: str, dry_run: bool) -> bool:
+    with open(path, newline='') as f:
+        text = f.read()
+        f.close()
+
+    tags = normalize_tags(re.split(r"[,\r\n]", text))
+    if len(tags) <= 0:
+        print(f"\nWARNING: Prompt file at '{path}' is empty.\n")
+
+    if ", ".join(tags) == text:
+        return False
+
+    if not dry_run:
+        write_tags(path, tags, atomic=True)
+
+    return True
 
 
 def generate_tag_list(src: str) -> list[str]:
@@ -178,12 +358,139 @@ def generate_prompt_list(src: str) -> list[str]:
     return unique_prompts
 
 
+def link_file(src: str, dst: str, mode: LinkMode = LinkMode.COPY) -> LinkMode:
+    """
+    Places ``src`` at ``dst`` using ``mode``, replacing ``dst`` if it exists. Falls back to a plain copy when the mode
+    is not possible, e.g. a hardlink across devices or a reflink on a filesystem without copy-on-write support.
+
+    :return: the mode that was actually used
+    """
+    # a copy onto a symlink would write through it into whatever file it points at
+    if (mode is not LinkMode.COPY or os.path.islink(dst)) and os.path.lexists(dst):
+        os.remove(dst)
+
+    if mode is LinkMode.HARDLINK:
+        try:
+            os.link(src, dst)
+            return mode
+        except OSError:
+            pass
+
+    elif mode is LinkMode.SYMLINK:
+        try:
+            os.symlink(os.path.abspath(src), dst)
+            return mode
+        except OSError:
+            pass
+
+    elif mode is LinkMode.REFLINK:
+        used_mode = __reflink_file(src, dst)
+        if used_mode is not None:
+            return used_mode
+
+    shutil.copyfile(src, dst)
+    return LinkMode.COPY
+
+
+def __reflink_file(src: str, dst: str) -> LinkMode | None:
+    """
+    :return: REFLINK when the extents are shared, COPY when ``copy_file_range`` copied the file, which may or may not
+    have shared them, or None when nothing was placed
+    """
+    try:
+        import fcntl
+    except ImportError:
+        fcntl = None
+
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(dst_file.fileno(), __ficlone, src_file.fileno())
+                return LinkMode.REFLINK
+            except OSError:
+                pass
+
+        if hasattr(os, "copy_file_range"):
+            # shares extents where the filesystem supports it, otherwise still copies without leaving the kernel
+            try:
+                remaining = os.fstat(src_file.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(src_file.fileno(), dst_file.fileno(), remaining)
+                    if copied <= 0:
+                        break
+
+                    remaining -= copied
+
+                if remaining <= 0:
+                    return LinkMode.COPY
+            except OSError:
+                pass
+
+    return None
+
+
 def prompt_warning(warning: str) -> bool:
     print()
     sanity_check = input(f"{warning} [y/N] ")
     return sanity_check and sanity_check.lower() == "y"
 
 
+def natural_sort_keys(names: list[str], strip_extension: bool = True) -> list[tuple]:
+    """
+    Sort keys for the entries of one directory, in the order the captioner's old comparator put them: names whose last
+    dot separated segment (before the extension) is a number sort by that number among names sharing the text before
+    it, and everything else compares as plain strings.
+
+    That comparator is not a total order, numerics compare by value among themselves but as strings against other
+    names (``10`` < ``1_cats`` < ``2`` < ``10``), so no key of a single name can reproduce it and the keys depend on
+    the whole directory: the non-numeric names, in string order, split the numeric ones into buckets by where they
+    sort as strings, and each bucket is ordered by value. Wherever the comparator was consistent this is exactly its
+    order, where it was not the order is still deterministic.
+
+    :return: a key per name, in the same order as ``names``
+    """
+    numerics: list[tuple[int, str, float, str]] = []
+    texts: list[str] = []
+
+    for i, name in enumerate(names):
+        segments = name.split(".")
+        if strip_extension and len(segments) >= 2:
+            stem, prefix = segments[-2], ".".join(segments[:-2])
+        else:
+            stem, prefix = segments[-1], ".".join(segments[:-1])
+
+        try:
+            value = float(stem)
+        except ValueError:
+            value = math.nan
+
+        if math.isnan(value):
+            texts.append(name)
+        else:
+            numerics.append((i, prefix, value, name))
+
+    texts.sort()
+
+    keys: list[tuple] = [None] * len(names)
+    for i, prefix, value, name in numerics:
+        keys[i] = bisect.bisect_left(texts, name), 0, prefix, value, name
+
+    text_keys = {name: (i, 1, "", 0.0, name) for i, name in enumerate(texts)}
+    for i, name in enumerate(names):
+        if keys[i] is None:
+            keys[i] = text_keys[name]
+
+    return keys
+
+
+def natural_sorted(items: list, name: Callable[[object], str], strip_extension: bool = True) -> list:
+    """
+    ``items`` sorted by ``natural_sort_keys`` of their names.
+    """
+    keys = natural_sort_keys([name(item) for item in items], strip_extension)
+    return [item for _, item in sorted(zip(keys, items), key=lambda x: x[0])]
+
+
 def is_image(filename: str) -> bool:
     ext = os.path.splitext(filename)[1]
     return ext in __img_extensions
@@ -1,87 +1,248 @@
 import argparse
+import multiprocessing
 import os
 import shutil
 import sys
 import time
 
-from fking.fking_captions import create_concept, print_concept_info
-from fking.fking_utils import fix_prompt_text_files, generate_prompt_list, prompt_warning, write_tags
+from fking.fking_cache import HashCache, ScanManifest
+from fking.fking_captions import CaptionStatistics, create_concept, print_concept_info
+from fking.fking_tag_ops import TagFileIndex, TagOperation, TagOperationMode, apply_tag_operations
+from fking.fking_utils import LinkMode, fix_prompt_text_files, prompt_warning
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--no-ui", default=True, dest="use_ui", action='store_false')
+    parser.add_argument("-i", "--input", type=str)
+    parser.add_argument("-o", "--output", type=str, default=None)
+    parser.add_argument("--overwrite", default=False, dest="overwrite", action='store_true')
+    parser.add_argument("--sync", default=False, dest="sync", action='store_true')
+    parser.add_argument("--preserve-underscores", default=False, dest="preserve_underscores", action='store_true')
+    parser.add_argument("--fix-prompts", default=False, dest="fix_prompts", action='store_true')
+    parser.add_argument("--dry-run", default=False, dest="dry_run", action='store_true')
+    parser.add_argument("--no-tree", default=True, dest="tree", action="store_false")
+    parser.add_argument("--no-manifest", default=True, dest="manifest", action="store_false")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--processes", default=False, dest="use_processes", action="store_true")
+    parser.add_argument("--no-hash-cache", default=True, dest="hash_cache", action="store_false")
+    parser.add_argument("--link-mode", type=LinkMode, default=LinkMode.COPY, choices=list(LinkMode),
+                        metavar="{" + ",".join(m.value for m in LinkMode) + "}")
+    parser.add_argument("--stats", default=False, dest="stats", action="store_true")
+    parser.add_argument("--rare-threshold", type=int, default=1)
+    parser.add_argument("--query", type=str, default=None)
+    parser.add_argument("--rename-tag", nargs=2, action="append", default=[], metavar=("TAG", "NEW_TAGS"))
+    parser.add_argument("--replace-tag", nargs=2, action="append", default=[], metavar=("TEXT", "NEW_TEXT"))
+    parser.add_argument("--delete-tag", action="append", default=[], metavar="TAG")
+    parser.add_argument("--add-if-has", nargs=2, action="append", default=[], metavar=("TAG", "NEW_TAGS"))
+    parser.add_argument("--generate-thumbnails", default=False, dest="generate_thumbnails", action="store_true")
+    parser.add_argument("--preview-cache-mb", type=int, default=None)
+    parser.add_argument("--grid-cache-mb", type=int, default=None)
+    parser.add_argument("--verify-hashes", default=False, dest="verify_hashes", action="store_true")
+
+    args = parser.parse_args()
+
+    if args.use_ui:
+        import fking.captioner.fking_captioner
+
+        fking.captioner.fking_captioner.show_ui(args.preview_cache_mb, args.grid_cache_mb)
+        sys.exit()
+
+    input_directory = args.input
+    output_directory = args.output
+
+    merge_directory = os.path.join(output_directory, "merged_dataset") if output_directory is not None else None
+
+    if args.overwrite and os.path.exists(output_directory):
+        if prompt_warning(f"Output directory exists; are you sure you want to overwrite?\n  '{output_directory}'"):
+            print()
+            print("Sanity check succeeded!")
+
+            print(f"Deleting output directory '{output_directory}', please wait...")
+            shutil.rmtree(output_directory)
+            pass
+
+        else:
+            print()
+            print("Exiting... Nothing was changed.")
+            exit()
+
+    if args.fix_prompts and args.dry_run:
+        fixable_files = fix_prompt_text_files(input_directory, dry_run=True, max_workers=args.workers)
 
-parser = argparse.ArgumentParser()
-parser.add_argument("--no-ui", default=True, dest="use_ui", action='store_false')
-parser.add_argument("-i", "--input", type=str)
-parser.add_argument("-o", "--output", type=str, default=None)
-parser.add_argument("--overwrite", default=False, dest="overwrite", action='store_true')
-parser.add_argument("--preserve-underscores", default=False, dest="preserve_underscores", action='store_true')
-parser.add_argument("--fix-prompts", default=False, dest="fix_prompts", action='store_true')
-parser.add_argument("--no-tree", default=True, dest="tree", action="store_false")
-
-args = parser.parse_args()
-
-if args.use_ui:
-    import fking.captioner.fking_captioner
-
-    fking.captioner.fking_captioner.show_ui()
-    sys.exit()
-
-input_directory = args.input
-output_directory = args.output
-
-merge_directory = os.path.join(output_directory, "merged_dataset") if output_directory is not None else None
-
-if args.overwrite and os.path.exists(output_directory):
-    if prompt_warning(f"Output directory exists; are you sure you want to overwrite?\n  '{output_directory}'"):
         print()
-        print("Sanity check succeeded!")
+        for fixable_file in fixable_files:
+            print(f"Would normalize '{fixable_file}'.")
 
-        print(f"Deleting output directory '{output_directory}', please wait...")
-        shutil.rmtree(output_directory)
-        pass
-
-    else:
         print()
-        print("Exiting... Nothing was changed.")
+        print(f"{len(fixable_files):,} prompt file(s) would change. Exiting... Nothing was changed.")
         exit()
 
-if args.fix_prompts:
-    if prompt_warning(f"Are you sure you want to normalize prompt files in input folder?\n  '{input_directory}'"
-                      f"\n\nThis action is irreversible."):
+    if args.fix_prompts:
+        if prompt_warning(f"Are you sure you want to normalize prompt files in input folder?\n  '{input_directory}'"
+                          f"\n\nThis action is irreversible."):
+            print()
+            print("Sanity check succeeded!")
+
+            print(f"Fixing prompts... this may take a while...")
+            fixed_files = fix_prompt_text_files(input_directory, max_workers=args.workers)
+            print(f"Normalized {len(fixed_files):,} prompt file(s).")
+
+        else:
+            print()
+            print("Exiting... Nothing was changed.")
+            exit()
+
+    print()
+    print("Generating output... please wait...")
+    print()
+
+    start_time_millis = time.time() * 1000.0
+    if args.manifest:
+        with ScanManifest(input_directory) as manifest:
+            global_concept = create_concept("global", input_directory, max_workers=args.workers, manifest=manifest)
+    else:
+        global_concept = create_concept("global", input_directory, max_workers=args.workers)
+
+    if args.tree:
+        print_concept_info(global_concept)
+
+    try:
+        tag_operations = [
+            *[TagOperation(TagOperationMode.RENAME, t, n.split(",")) for t, n in args.rename_tag],
+            *[TagOperation(TagOperationMode.REPLACE, t, [n]) for t, n in args.replace_tag],
+            *[TagOperation(TagOperationMode.DELETE, t) for t in args.delete_tag],
+            *[TagOperation(TagOperationMode.ADD_IF_HAS, t, n.split(",")) for t, n in args.add_if_has],
+        ]
+    except ValueError as e:
+        parser.error(str(e))
+
+    if len(tag_operations) > 0:
         print()
-        print("Sanity check succeeded!")
+        for operation in tag_operations:
+            print(f"Tag operation: {operation}")
+
+        if not args.dry_run and not prompt_warning(f"Are you sure you want to edit tags in input folder?\n  "
+                                                   f"'{input_directory}'\n\nThis action is irreversible."):
+            print()
+            print("Exiting... Nothing was changed.")
+            exit()
+
+        tag_changes = apply_tag_operations(
+                TagFileIndex.from_concept(global_concept),
+                tag_operations,
+                dry_run=args.dry_run,
+                max_workers=args.workers
+        )
 
-        print(f"Fixing prompts... this may take a while...")
-        fix_prompt_text_files(input_directory)
-        pass
+        print()
+        for path, old_tags, new_tags in tag_changes:
+            removed = [t for t in old_tags if t not in new_tags]
+            added = [t for t in new_tags if t not in old_tags]
+            print(f"{'Would change' if args.dry_run else 'Changed'} '{path}': "
+                  f"-[{', '.join(removed)}] +[{', '.join(added)}]")
 
-    else:
         print()
-        print("Exiting... Nothing was changed.")
-        exit()
+        if args.dry_run:
+            print(f"{len(tag_changes):,} file(s) would change. Exiting... Nothing was changed.")
+            exit()
 
-print()
-print("Generating output... please wait...")
-print()
+        print(f"Changed {len(tag_changes):,} file(s).")
 
-start_time_millis = time.time() * 1000.0
-global_concept = create_concept("global", input_directory)
+    if args.generate_thumbnails:
+        from fking.captioner.fk_thumbnail_cache import ThumbnailCache
 
-if args.tree:
-    print_concept_info(global_concept)
+        thumbnail_cache = ThumbnailCache(input_directory)
+        generated = thumbnail_cache.generate(
+                [img.path for img in global_concept.iter_flatten()],
+                max_workers=args.workers
+        )
 
-if output_directory is not None:
-    global_concept.write(merge_directory)
+        end_time_millis = time.time() * 1000.0
+        print(f"Generated {generated:,} thumbnail(s) in '{thumbnail_cache.directory}' in "
+              f"{(end_time_millis - start_time_millis) / 1000.0:.2f}s.")
 
-    unique_prompts = generate_prompt_list(merge_directory)
-    unique_prompts_file_path = os.path.join(output_directory, "unique_prompt.txt")
-    with open(unique_prompts_file_path, "w+") as f:
-        f.writelines(up + "\n" for up in unique_prompts)
-        f.close()
+    if args.query is not None:
+        from fking.fking_index import TagIndex
 
-    unique_tags = sum([prompt.split(', ') for prompt in unique_prompts], [])
-    unique_tags_file_path = os.path.join(output_directory, "unique_tags.txt")
-    write_tags(unique_tags_file_path, unique_tags)
+        tag_index = TagIndex.from_captioned_images(global_concept.iter_flatten(), use_paths=True)
+        index_time_millis = time.time() * 1000.0
 
-    end_time_millis = time.time() * 1000.0
+        try:
+            matches = tag_index.query_keys(args.query)
+        except ValueError as e:
+            print(f"Invalid query: {e}")
+            exit(1)
 
-print("Done.")
-print()
+        query_time_millis = time.time() * 1000.0
+
+        for path in matches:
+            print(path)
+
+        print()
+        print(f"{len(matches):,} of {len(tag_index):,} images match '{args.query}' "
+              f"(indexed in {(index_time_millis - start_time_millis) / 1000.0:.2f}s, "
+              f"queried in {query_time_millis - index_time_millis:.2f}ms).")
+
+    elif args.stats:
+        from fking.fking_stats import TagAnalytics
+
+        analytics = TagAnalytics().add_all(global_concept.iter_flatten())
+
+        end_time_millis = time.time() * 1000.0
+        print(f"Analyzed {analytics.image_count:,} images, {analytics.count_tags():,} tags and "
+              f"{len(analytics.concepts):,} concepts in {(end_time_millis - start_time_millis) / 1000.0:.2f}s.")
+
+        if output_directory is not None:
+            stats_directory = os.path.join(output_directory, "tag_stats")
+            analytics.write(stats_directory, args.rare_threshold)
+            print(f"Wrote tag statistics to '{stats_directory}'.")
+
+    elif output_directory is not None:
+        hash_cache = HashCache(input_directory, args.verify_hashes) if args.hash_cache else None
+
+        stats = CaptionStatistics()
+
+        if args.sync:
+            placed, written, deleted, written_images = global_concept.sync(
+                    merge_directory,
+                    args.workers,
+                    args.use_processes,
+                    hash_cache,
+                    args.link_mode,
+                    stats
+            )
+
+            print(f"Synced output: {placed:,} image(s) added, {written:,} caption(s) written, "
+                  f"{deleted:,} stale file(s) deleted.")
+        else:
+            written_images = 0
+            for _ in global_concept.iter_write(
+                    merge_directory,
+                    args.workers,
+                    args.use_processes,
+                    hash_cache,
+                    args.link_mode,
+                    stats
+            ):
+                written_images += 1
+
+        if hash_cache is not None:
+            hash_cache.save()
+
+            if hash_cache.mismatches > 0:
+                print(f"Replaced {hash_cache.mismatches:,} stale cached hash(es).")
+
+        stats.write(output_directory)
+
+        end_time_millis = time.time() * 1000.0
+        print(f"Flattened {written_images:,} images in {(end_time_millis - start_time_millis) / 1000.0:.2f}s.")
+
+    print("Done.")
+    print()
+
+
+if __name__ == "__main__":
+    # process pools re-import this module in their workers, guard against re-running the cli in each of them
+    multiprocessing.freeze_support()
+    main()
@@ -0,0 +1,108 @@
+import os
+
+import pytest
+
+import fking.fking_captions
+from fking.fking_captions import create_concept
+from fking.fking_utils import LinkMode, link_file, read_tags_from_file, write_tags
+
+
+def test_duplicate_images_write_one_caption(tmp_path, monkeypatch):
+    dataset = tmp_path / "dataset"
+    output = tmp_path / "output"
+
+    # 500 copies of one image spread over two concepts, each with a caption of its own
+    for c in range(2):
+        concept = dataset / f"concept_{c}"
+        concept.mkdir(parents=True)
+        (concept / "__prompt.txt").write_text(f"concept {c}")
+
+        for i in range(250):
+            (concept / f"{i}.png").write_bytes(b"\x89PNG same content")
+            (concept / f"{i}.txt").write_text(f"tag {i % 10}, shared")
+
+    calls = {"write": [], "read": [], "link": []}
+
+    def counted(name, function):
+        def wrapper(path, *args, **kwargs):
+            calls[name].append(str(path))
+            return function(path, *args, **kwargs)
+
+        return wrapper
+
+    monkeypatch.setattr(fking.fking_captions, "write_tags",
+                        counted("write", fking.fking_captions.write_tags))
+    monkeypatch.setattr(fking.fking_captions, "read_tags_from_file",
+                        counted("read", fking.fking_captions.read_tags_from_file))
+    monkeypatch.setattr(fking.fking_captions, "link_file",
+                        counted("link", fking.fking_captions.link_file))
+
+    root = create_concept("global", str(dataset))
+    calls["read"].clear()
+
+    written = root.write(str(output), max_workers=4)
+
+    assert len(written) == 500
+    assert len({img.path for img in written}) == 1
+
+    # one image and one caption placed for all 500 copies, and nothing read back from the output
+    assert len(calls["link"]) == 1
+    assert len(calls["write"]) == 1
+    assert not any(path.startswith(str(output)) for path in calls["read"])
+
+    caption_path = os.path.splitext(written[0].path)[0] + ".txt"
+    assert calls["write"] == [caption_path]
+
+    caption = read_tags_from_file(caption_path)
+    assert set(caption) == {"concept 0", "concept 1", "shared"} | {f"tag {i}" for i in range(10)}
+    assert sorted(os.listdir(output)) == sorted([os.path.basename(written[0].path), os.path.basename(caption_path)])
+
+
+def test_same_content_with_other_extensions_places_each(tmp_path):
+    dataset = tmp_path / "dataset"
+    output = tmp_path / "output"
+
+    concept = dataset / "a"
+    concept.mkdir(parents=True)
+    (concept / "1.png").write_bytes(b"same content")
+    (concept / "2.jpg").write_bytes(b"same content")
+    (concept / "1.txt").write_text("png tag")
+    (concept / "2.txt").write_text("jpg tag")
+
+    written = create_concept("global", str(dataset)).write(str(output), max_workers=2)
+
+    # one output per extension, sharing a single merged caption
+    assert sorted(os.path.splitext(img.path)[1] for img in written) == [".jpg", ".png"]
+    assert all(os.path.exists(img.path) for img in written)
+
+    captions = [n for n in os.listdir(output) if n.endswith(".txt")]
+    assert len(captions) == 1
+    assert set(read_tags_from_file(os.path.join(output, captions[0]))) == {"png tag", "jpg tag"}
+
+
+def test_atomic_write_failure_keeps_original_error(tmp_path):
+    missing = tmp_path / "missing" / "0.txt"
+
+    with pytest.raises(FileNotFoundError) as e:
+        write_tags(str(missing), ["a"], atomic=True)
+
+    # the error of the failed open, not one raised while cleaning up a temporary file that was never created
+    assert e.value.filename.startswith(str(missing.parent))
+    assert not e.value.__context__
+
+
+def test_reflink_reports_copy_without_clone(tmp_path, monkeypatch):
+    fcntl = pytest.importorskip("fcntl")
+
+    def no_clone(*args):
+        raise OSError("FICLONE not supported")
+
+    monkeypatch.setattr(fcntl, "ioctl", no_clone)
+
+    src = tmp_path / "0.png"
+    src.write_bytes(b"image" * 1000)
+    dst = tmp_path / "1.png"
+
+    # copy_file_range may or may not have shared the extents, only a successful clone is reported as a reflink
+    assert link_file(str(src), str(dst), LinkMode.REFLINK) is LinkMode.COPY
+    assert dst.read_bytes() == src.read_bytes()
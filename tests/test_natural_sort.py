@@ -0,0 +1,77 @@
+import itertools
+import random
+from functools import cmp_to_key
+
+from benchmarks.legacy_sort import legacy_compare
+from fking.fking_utils import natural_sorted
+
+
+def legacy_sorted(names: list[str]) -> list[str] | None:
+    """
+    :return: the legacy order of ``names`` in one directory, None where the comparator is not consistent for them
+    """
+    canonical = {f"global.concept.{n}": n for n in names}
+    ordered = sorted(canonical, key=cmp_to_key(legacy_compare))
+
+    for a, b in itertools.combinations(ordered, 2):
+        if legacy_compare(a, b) > 0:
+            return None
+
+    return [canonical[c] for c in ordered]
+
+
+def assert_legacy_order(names: list[str], strip_extension: bool) -> bool:
+    expected = legacy_sorted(names)
+    if expected is None:
+        return False
+
+    actual = natural_sorted(names, lambda n: n, strip_extension)
+
+    # equal numbers such as 012 and 12 were ties the legacy sort left in input order, they are broken by name now
+    canonical = [f"global.concept.{n}" for n in actual]
+    assert all(legacy_compare(a, b) <= 0 for a, b in itertools.combinations(canonical, 2)), (names, actual, expected)
+    return True
+
+
+def test_numeric_against_text_sorts_as_strings():
+    assert natural_sorted(["2", "1_cats"], lambda n: n, strip_extension=False) == ["1_cats", "2"]
+    assert natural_sorted(["5.png", "4a.png"], lambda n: n) == ["4a.png", "5.png"]
+    assert natural_sorted(["b.png", "10.png", "9.png", "a.png"], lambda n: n) == ["9.png", "10.png", "a.png", "b.png"]
+
+
+def test_numeric_sorts_by_value_within_prefix():
+    assert natural_sorted(["b.10.png", "b.2.png", "b.1.png", "a.png"], lambda n: n) == \
+           ["a.png", "b.1.png", "b.2.png", "b.10.png"]
+    assert natural_sorted(["100", "20", "3"], lambda n: n, strip_extension=False) == ["3", "20", "100"]
+
+
+def test_randomized_directories_match_legacy_order():
+    rng = random.Random(1234)
+
+    def random_name() -> str:
+        kind = rng.randrange(6)
+        if kind == 0:
+            return str(rng.randrange(200))
+        elif kind == 1:
+            return f"{rng.randrange(200):05d}"
+        elif kind == 2:
+            return f"{rng.randrange(20)}{rng.choice(['a', '_cats', ' copy', '-1'])}"
+        elif kind == 3:
+            return rng.choice(["cat", "dog", "Zebra", "_misc", "img_", "image"]) + str(rng.randrange(20))
+        elif kind == 4:
+            return f"{rng.choice(['a', 'b'])}.{rng.randrange(30)}"
+        else:
+            return f"{rng.randrange(10)}.{rng.randrange(10)}"
+
+    consistent = 0
+    for _ in range(600):
+        stems = list(dict.fromkeys(random_name() for _ in range(rng.randrange(1, 12))))
+
+        if assert_legacy_order([f"{s}.png" for s in stems], strip_extension=True):
+            consistent += 1
+
+        if assert_legacy_order(stems, strip_extension=False):
+            consistent += 1
+
+    # most generated directories mix numeric and text names, the legacy order must have been checkable for them
+    assert consistent > 300